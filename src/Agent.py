@@ -1,14 +1,13 @@
 import numpy as np
 
-from BidderAllocation import PyTorchLogisticRegressionAllocator, OracleAllocator
-from Impression import ImpressionOpportunity
+from Impression import ImpressionLog
 from Models import sigmoid
 
 
 class Agent:
     ''' An agent representing an advertiser '''
 
-    def __init__(self, rng, name, num_items, item_values, allocator, bidder, memory=0):
+    def __init__(self, rng, name, num_items, item_values, allocator, bidder, memory=0, participation_rate=1.0):
         self.rng = rng
         self.name = name
         self.num_items = num_items
@@ -19,27 +18,29 @@ class Agent:
         self.net_utility = .0
         self.gross_utility = .0
 
-        self.logs = []
+        self.logs = ImpressionLog()
 
         self.allocator = allocator
         self.bidder = bidder
 
         self.memory = memory
 
+        # Relative rate at which this agent is sampled to participate in auction rounds
+        self.participation_rate = participation_rate
+
     def select_item(self, context):
         # Estimate CTR for all items
-        estim_CTRs = self.allocator.estimate_CTR(context)
+        # If we do Thompson Sampling, don't propagate the noisy bid amount but bid using the MAP estimate
+        if getattr(self.allocator, 'thompson_sampling', False):
+            estim_CTRs, estim_CTRs_MAP = self.allocator.estimate_CTR_and_MAP(context)
+        else:
+            estim_CTRs = estim_CTRs_MAP = self.allocator.estimate_CTR(context)
         # Compute value if clicked
         estim_values = estim_CTRs * self.item_values
         # Pick the best item (according to TS)
         best_item = np.argmax(estim_values)
 
-        # If we do Thompson Sampling, don't propagate the noisy bid amount but bid using the MAP estimate
-        if type(self.allocator) == PyTorchLogisticRegressionAllocator and self.allocator.thompson_sampling:
-            estim_CTRs_MAP = self.allocator.estimate_CTR(context, sample=False)
-            return best_item, estim_CTRs_MAP[best_item]
-
-        return best_item, estim_CTRs[best_item]
+        return best_item, estim_CTRs_MAP[best_item]
 
     def bid(self, context):
         # First, pick what item we want to choose
@@ -51,81 +52,167 @@ class Agent:
         # Get the bid
         bid = self.bidder.bid(value, context, estimated_CTR)
 
-        # Log what we know so far
-        self.logs.append(ImpressionOpportunity(context=context,
-                                               item=best_item,
-                                               estimated_CTR=estimated_CTR,
-                                               value=value,
-                                               bid=bid,
-                                               # These will be filled out later
-                                               best_expected_value=0.0,
-                                               true_CTR=0.0,
-                                               price=0.0,
-                                               second_price=0.0,
-                                               outcome=0,
-                                               won=False))
+        # Log what we know so far -- the rest is filled out once the auction is resolved
+        self.logs.append(context=context,
+                         item=best_item,
+                         value=value,
+                         bid=bid,
+                         estimated_CTR=estimated_CTR)
 
         return bid, best_item
 
+    def select_item_batch(self, contexts):
+        # Estimate CTR for all items, for every context
+        # If we do Thompson Sampling, don't propagate the noisy bid amount but bid using the MAP estimate
+        if getattr(self.allocator, 'thompson_sampling', False):
+            estim_CTRs, estim_CTRs_MAP = self.allocator.estimate_CTR_batch_and_MAP(contexts)
+        else:
+            estim_CTRs = estim_CTRs_MAP = self.allocator.estimate_CTR_batch(contexts)
+        # Pick the best item per context (according to TS)
+        best_items = np.argmax(estim_CTRs * self.item_values, axis=1)
+
+        return best_items, estim_CTRs_MAP[np.arange(len(best_items)), best_items]
+
+    def bid_batch(self, contexts):
+        # First, pick what items we want to choose
+        best_items, estimated_CTRs = self.select_item_batch(contexts)
+
+        # Values for these items
+        values = self.item_values[best_items]
+
+        # Get the bids
+        bids, _, _ = self.bidder.bid_batch(values, contexts, estimated_CTRs)
+
+        # Log what we know so far -- outcomes are filled out in bulk by `charge_batch`
+        self.logs.extend(contexts=contexts,
+                         items=best_items,
+                         values=values,
+                         bids=bids,
+                         estimated_CTRs=estimated_CTRs)
+
+        return bids, best_items
+
     def charge(self, price, second_price, outcome):
-        self.logs[-1].set_price_outcome(price, second_price, outcome, won=True)
-        last_value = self.logs[-1].value * outcome
+        self.logs.set_price_outcome(-1, price, second_price, outcome, won=True)
+        last_item = self.logs.read('item', -1)
+        last_value = self.item_values[last_item] * outcome
+        if self.allocator.online:
+            self.allocator.observe(self.logs.read('context', -1)[None], [last_item], [outcome])
         self.net_utility += (last_value - price)
         self.gross_utility += last_value
 
+    def charge_batch(self, best_expected_values, true_CTRs, prices, second_prices, competing_bids, outcomes, won, conversions, sales_revenues):
+        ''' Record the outcomes of the last `len(prices)` opportunities from `bid_batch`, won or lost '''
+        rows = self.logs.last(len(prices))
+        self.logs.set_true_CTR(rows, best_expected_values, true_CTRs)
+        self.logs.set_price_outcome(rows, prices, second_prices, outcomes, won=won)
+        self.logs.set_competing_bid(rows, competing_bids)
+        self.logs.set_conversion_details(rows, conversions, sales_revenues)
+
+        items = self.logs.read('item', rows)
+        values = self.item_values[items] * outcomes
+        self.net_utility += np.sum((values - prices)[won])
+        self.gross_utility += np.sum(values[won])
+        if self.allocator.online:
+            # Learn from the won impressions in the order they happened
+            self.allocator.observe(self.logs.read('context', rows)[won], items[won], outcomes[won])
+
     def set_price(self, price):
-        self.logs[-1].set_price(price)
+        self.logs.set_price(-1, price)
 
     def update(self, iteration, plot=False, figsize=(8,5), fontsize=14):
-        # Gather relevant logs
-        contexts = np.array(list(opp.context for opp in self.logs))
-        items = np.array(list(opp.item for opp in self.logs))
-        values = np.array(list(opp.value for opp in self.logs))
-        bids = np.array(list(opp.bid for opp in self.logs))
-        prices = np.array(list(opp.price for opp in self.logs))
-        outcomes = np.array(list(opp.outcome for opp in self.logs))
-        estimated_CTRs = np.array(list(opp.estimated_CTR for opp in self.logs))
+        # Gather relevant logs -- zero-copy views on the log columns
+        contexts = self.logs.contexts
+        items = self.logs.items
+        values = self.logs.values
+        bids = self.logs.bids
+        prices = self.logs.prices
+        outcomes = self.logs.outcomes
+        estimated_CTRs = self.logs.estimated_CTRs
 
         # Update response model with data from winning bids
-        won_mask = np.array(list(opp.won for opp in self.logs))
+        won_mask = self.logs.won
         self.allocator.update(contexts[won_mask], items[won_mask], outcomes[won_mask], iteration, plot, figsize, fontsize, self.name)
 
         # Update bidding model with all data
+        self.bidder.observe_competing_bids(self.logs.competing_bids)
         self.bidder.update(contexts, values, bids, prices, outcomes, estimated_CTRs, won_mask, iteration, plot, figsize, fontsize, self.name)
 
+    def metrics(self):
+        ''' Every per-iteration metric over the logged opportunities, computed in a single pass over the log columns '''
+        logs = self.logs
+        # Read every column once -- these are views, unless the memory window wraps around the buffer
+        values = logs.values
+        bids = logs.bids
+        best_expected_values = logs.best_expected_values
+        true_CTRs = logs.true_CTRs
+        estimated_CTRs = logs.estimated_CTRs
+        prices = logs.prices
+        won = logs.won
+        clicked = won & logs.outcomes
+        converted = won & logs.conversions
+
+        true_values = true_CTRs * values
+        total_clicks = int(np.count_nonzero(clicked))
+        total_conversions = int(np.count_nonzero(converted))
+        total_sales_revenue = float(np.sum(logs.sales_revenues[converted], dtype=np.float64))
+        total_spend = float(np.sum(prices[won], dtype=np.float64))
+
+        if total_sales_revenue == 0:
+            ACoS = 0.0 if total_spend == 0 else np.inf
+        else:
+            ACoS = total_spend / total_sales_revenue
+
+        return {
+            # How much value am I missing out on due to suboptimal allocation?
+            'allocation_regret': np.sum(best_expected_values - true_values, dtype=np.float64),
+            # How much am I overpaying due to over-estimation of the value?
+            'estimation_regret': np.sum(estimated_CTRs * values - true_values, dtype=np.float64),
+            # How much am I overpaying because I could shade more?
+            'overbid_regret': np.sum((prices - logs.second_prices) * won, dtype=np.float64),
+            # How much have I lost because I could have shaded less?
+            # The difference between the winning price and our bid -- for opportunities we lost, and where we could have won without overpaying
+            # Important to mention that this assumes a first-price auction! i.e. the price is the winning bid
+            'underbid_regret': np.sum((prices - bids) * (~won & (prices < true_values)), dtype=np.float64),
+            'CTR_RMSE': np.sqrt(np.mean((true_CTRs - estimated_CTRs)**2, dtype=np.float64)),
+            'CTR_bias': np.mean(estimated_CTRs[won] / true_CTRs[won], dtype=np.float64),
+            'total_clicks': total_clicks,
+            'total_conversions': total_conversions,
+            'total_sales_revenue': total_sales_revenue,
+            'total_spend': total_spend,
+            'CVR': total_conversions / total_clicks if total_clicks else 0.0,
+            'ACoS': ACoS,
+            'best_expected_value': np.mean(best_expected_values, dtype=np.float64),
+        }
+
     def get_allocation_regret(self):
         ''' How much value am I missing out on due to suboptimal allocation? '''
-        return np.sum(list(opp.best_expected_value - opp.true_CTR * opp.value for opp in self.logs))
+        return self.metrics()['allocation_regret']
 
     def get_estimation_regret(self):
         ''' How much am I overpaying due to over-estimation of the value? '''
-        return np.sum(list(opp.estimated_CTR * opp.value - opp.true_CTR * opp.value for opp in self.logs))
+        return self.metrics()['estimation_regret']
 
     def get_overbid_regret(self):
         ''' How much am I overpaying because I could shade more? '''
-        return np.sum(list((opp.price - opp.second_price) * opp.won for opp in self.logs))
+        return self.metrics()['overbid_regret']
 
     def get_underbid_regret(self):
         ''' How much have I lost because I could have shaded less? '''
-        # The difference between the winning price and our bid -- for opportunities we lost, and where we could have won without overpaying
-        # Important to mention that this assumes a first-price auction! i.e. the price is the winning bid
-        return np.sum(list((opp.price - opp.bid) * (not opp.won) * (opp.price < (opp.true_CTR * opp.value)) for opp in self.logs))
+        return self.metrics()['underbid_regret']
 
     def get_CTR_RMSE(self):
-        return np.sqrt(np.mean(list((opp.true_CTR - opp.estimated_CTR)**2 for opp in self.logs)))
+        return self.metrics()['CTR_RMSE']
 
     def get_CTR_bias(self):
-        return np.mean(list((opp.estimated_CTR / opp.true_CTR) for opp in filter(lambda opp: opp.won, self.logs)))
+        return self.metrics()['CTR_bias']
 
     def clear_utility(self):
         self.net_utility = .0
         self.gross_utility = .0
 
     def clear_logs(self):
-        if not self.memory:
-            self.logs = []
-        else:
-            self.logs = self.logs[-self.memory:]
+        self.logs.clear(keep=self.memory)
         # Ensure bidder's clear_logs is also called, as it might have its own memory management.
         # This was missing in the original provided Agent.py but is good practice if Bidder has logs.
         if hasattr(self.bidder, 'clear_logs'):
@@ -133,34 +220,24 @@ class Agent:
 
     def get_total_clicks(self) -> int:
         """Returns the total number of clicks the agent received for impressions they won."""
-        return sum(1 for opp in self.logs if opp.won and opp.outcome)
+        return self.metrics()['total_clicks']
 
     def get_total_conversions(self) -> int:
         """Returns the total number of conversions the agent achieved for impressions they won."""
-        return sum(1 for opp in self.logs if opp.won and opp.conversion)
+        return self.metrics()['total_conversions']
 
     def get_total_sales_revenue(self) -> float:
         """Returns the total sales revenue generated from conversions for impressions they won."""
-        # Ensure sales_revenue is treated as float, np.float32 should sum correctly.
-        return sum(float(opp.sales_revenue) for opp in self.logs if opp.won and opp.conversion)
+        return self.metrics()['total_sales_revenue']
 
     def get_total_spend(self) -> float:
         """Returns the total amount spent by the agent on winning bids."""
-        # Ensure price is treated as float, np.float32 should sum correctly.
-        return sum(float(opp.price) for opp in self.logs if opp.won)
+        return self.metrics()['total_spend']
 
     def get_CVR(self) -> float:
         """Calculates the Conversion Rate (Total Conversions / Total Clicks)."""
-        total_clicks = self.get_total_clicks()
-        if total_clicks == 0:
-            return 0.0
-        total_conversions = self.get_total_conversions()
-        return total_conversions / total_clicks
+        return self.metrics()['CVR']
 
     def get_ACoS(self) -> float:
         """Calculates the Advertising Cost of Sales (Total Spend / Total Sales Revenue)."""
-        total_spend = self.get_total_spend()
-        total_sales_revenue = self.get_total_sales_revenue()
-        if total_sales_revenue == 0:
-            return 0.0 if total_spend == 0 else np.inf
-        return total_spend / total_sales_revenue
+        return self.metrics()['ACoS']
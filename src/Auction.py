@@ -5,13 +5,21 @@ import numpy as np
 
 from BidderAllocation import OracleAllocator
 from Models import sigmoid
+from ParticipantSampler import ParticipantSampler
+from RandomStreams import RandomStreams
 
 class Auction:
     ''' Base class for auctions '''
     def __init__(self, rng, allocation, agents, agent2items, agents2item_values, 
                  max_slots, embedding_size, embedding_var, obs_embedding_size, 
-                 num_participants_per_round, fixed_cvr: float, fixed_sales_revenue_per_conversion: float):
+                 num_participants_per_round, fixed_cvr: float, fixed_sales_revenue_per_conversion: float, streams=None):
         self.rng = rng
+        # Every random quantity can come from its own block-drawn stream, or all from the shared generator
+        self.slots_rng = streams.stream(RandomStreams.SLOTS) if streams else rng
+        self.contexts_rng = streams.stream(RandomStreams.CONTEXTS) if streams else rng
+        self.participants_rng = streams.stream(RandomStreams.PARTICIPANTS) if streams else rng
+        self.clicks_rng = streams.stream(RandomStreams.CLICKS) if streams else rng
+        self.conversions_rng = streams.stream(RandomStreams.CONVERSIONS) if streams else rng
         self.allocation = allocation
         self.agents = agents
         self.max_slots = max_slots
@@ -20,12 +28,24 @@ class Auction:
         self.agent2items = agent2items
         self.agents2item_values = agents2item_values
 
+        # Pack every agent's catalogue into padded tensors indexed by agent id.
+        # Padded items have zero value, so they never affect the best expected value.
+        max_items = max(len(agents2item_values[agent.name]) for agent in agents)
+        self.item_embeddings = np.zeros((len(agents), max_items, embedding_size + 1), dtype=np.float32)
+        self.item_values = np.zeros((len(agents), max_items), dtype=np.float32)
+        for agent_idx, agent in enumerate(agents):
+            num_items = len(agents2item_values[agent.name])
+            self.item_embeddings[agent_idx, :num_items] = agent2items[agent.name]
+            self.item_values[agent_idx, :num_items] = agents2item_values[agent.name]
+
         self.embedding_size = embedding_size
         self.embedding_var = embedding_var
 
         self.obs_embedding_size = obs_embedding_size
 
         self.num_participants_per_round = num_participants_per_round
+        self.participant_sampler = ParticipantSampler(len(agents), num_participants_per_round,
+                                                      participation_rates=[agent.participation_rate for agent in agents])
 
         # New parameters for CVR and sales revenue
         self.fixed_cvr = fixed_cvr
@@ -33,10 +53,10 @@ class Auction:
 
     def simulate_opportunity(self):
         # Sample the number of slots uniformly between [1, max_slots]
-        num_slots = self.rng.integers(1, self.max_slots + 1)
+        num_slots = self.slots_rng.integers(1, self.max_slots + 1)
 
         # Sample a true context vector
-        true_context = np.concatenate((self.rng.normal(0, self.embedding_var, size=self.embedding_size), [1.0]))
+        true_context = np.concatenate((self.contexts_rng.normal(0, self.embedding_var, size=self.embedding_size), [1.0]))
 
         # Mask true context into observable context
         obs_context = np.concatenate((true_context[:self.obs_embedding_size], [1.0]))
@@ -45,19 +65,20 @@ class Auction:
         # the list of bidders that might want to compete.
         bids = []
         CTRs = []
-        participating_agents_idx = self.rng.choice(len(self.agents), self.num_participants_per_round, replace=False)
+        participating_agents_idx = self.participant_sampler.sample(self.participants_rng)
         participating_agents = [self.agents[idx] for idx in participating_agents_idx]
-        for agent in participating_agents:
+        # Compute the true CTRs for the catalogues of all participants at once
+        true_CTRs = sigmoid(self.item_embeddings[participating_agents_idx] @ true_context.astype(np.float32))
+        best_expected_values = np.max(true_CTRs * self.item_values[participating_agents_idx], axis=1)
+        for i, agent in enumerate(participating_agents):
             # Get the bid and the allocated item
             if isinstance(agent.allocator, OracleAllocator):
                 bid, item = agent.bid(true_context)
             else:
                 bid, item = agent.bid(obs_context)
             bids.append(bid)
-            # Compute the true CTRs for items in this agent's catalogue
-            true_CTR = sigmoid(true_context @ self.agent2items[agent.name].T)
-            agent.logs[-1].set_true_CTR(np.max(true_CTR * self.agents2item_values[agent.name]), true_CTR[item])
-            CTRs.append(true_CTR[item])
+            agent.logs.set_true_CTR(-1, best_expected_values[i], true_CTRs[i, item])
+            CTRs.append(true_CTRs[i, item])
         bids = np.array(bids)
         CTRs = np.array(CTRs)
 
@@ -65,12 +86,14 @@ class Auction:
         # "second_prices" tell us how much lower the winner could have gone without changing the outcome
         # winner_indices_in_bids are indices relative to the `bids` array (and thus `participating_agents`)
         winner_indices_in_bids, slot_prices, slot_second_prices = self.allocation.allocate(bids, num_slots)
+        # What every participant was up against -- the bid landscape
+        competing_bids = self.allocation.competing_bids(bids.reshape(1, -1), num_slots)[0]
 
         # Bidders only obtain value when they get their outcome
         # Either P(view), P(click | view, ad), P(conversion | click, view, ad)
         # For now, look at P(click | ad) * P(view)
         # Determine click outcomes for the winning slots
-        clicks_on_winning_slots = self.rng.binomial(1, CTRs[winner_indices_in_bids])
+        clicks_on_winning_slots = self.clicks_rng.binomial(1, CTRs[winner_indices_in_bids])
 
         # Store details for winners to process revenue and charge them correctly.
         # This map stores the outcome for the specific slot an agent won.
@@ -98,17 +121,97 @@ class Auction:
                 agent.charge(price, second_price, click_outcome)  # Updates agent's log with win, price, and click
                 
                 if click_outcome:  # Conversion can only happen if there was a click
-                    conversion_occurred = self.rng.random() < self.fixed_cvr
+                    conversion_occurred = self.conversions_rng.random() < self.fixed_cvr
                     if conversion_occurred:
                         current_sales_revenue = self.fixed_sales_revenue_per_conversion
             else:  # Agent 'i' lost
                 # Explicitly set outcome for losers in their log.
-                # ImpressionOpportunity defaults (won=False, outcome=0, price=0.0) are set during agent.bid()
+                # Log defaults (won=False, outcome=0, price=0.0) are set during agent.bid()
                 # Calling set_price_outcome ensures these are explicitly recorded as such.
-                agent.logs[-1].set_price_outcome(price=0.0, second_price=0.0, outcome=False, won=False)
+                agent.logs.set_price_outcome(-1, price=0.0, second_price=0.0, outcome=False, won=False)
             
             # Set conversion details for every participating agent's log entry
-            agent.logs[-1].set_conversion_details(conversion_occurred, current_sales_revenue)
+            agent.logs.set_conversion_details(-1, conversion_occurred, current_sales_revenue)
+            agent.logs.set_competing_bid(-1, competing_bids[i])
+
+    def simulate_batch(self, num_rounds):
+        ''' Simulate `num_rounds` independent auction rounds in one vectorised pass '''
+        # Agents only learn at iteration boundaries, so rounds within a batch are independent
+        # and every quantity can be drawn for the whole block at once.
+        num_participants = self.num_participants_per_round
+
+        # Sample the number of slots for every round
+        num_slots = self.slots_rng.integers(1, self.max_slots + 1, size=num_rounds)
+
+        # Sample true contexts and mask them into observable contexts
+        ones = np.ones((num_rounds, 1))
+        true_contexts = np.hstack((self.contexts_rng.normal(0, self.embedding_var, size=(num_rounds, self.embedding_size)), ones))
+        obs_contexts = np.hstack((true_contexts[:, :self.obs_embedding_size], ones))
+
+        # Sample participants without replacement for every round
+        participants = self.participant_sampler.sample(self.participants_rng, num_rounds)
+
+        # Compute the true CTRs for every participant's catalogue in every round with one batched matmul
+        true_CTRs = sigmoid((self.item_embeddings[participants] @ true_contexts.astype(np.float32)[:, None, :, None])[..., 0])
+        best_expected_values = np.max(true_CTRs * self.item_values[participants], axis=2)
+
+        # Solicit bids from every agent for all rounds it participates in
+        bids = np.zeros((num_rounds, num_participants))
+        CTRs = np.zeros((num_rounds, num_participants))
+        agent2rows = {}
+        # Group the (round, participant) cells by agent -- a stable sort keeps every agent's rounds in order
+        flat_participants = participants.ravel()
+        order = np.argsort(flat_participants, kind='stable')
+        agent_ids, starts = np.unique(flat_participants[order], return_index=True)
+        for agent_idx, cells in zip(agent_ids, np.split(order, starts[1:])):
+            agent = self.agents[agent_idx]
+            rows, cols = np.divmod(cells, num_participants)
+            if isinstance(agent.allocator, OracleAllocator):
+                agent_bids, items = agent.bid_batch(true_contexts[rows])
+            else:
+                agent_bids, items = agent.bid_batch(obs_contexts[rows])
+            bids[rows, cols] = agent_bids
+            CTRs[rows, cols] = true_CTRs[rows, cols, items]
+            agent2rows[agent_idx] = (rows, cols)
+
+        # Allocate slots for every round -- unused slots have a winner index of -1
+        winners, slot_prices, slot_second_prices = self.allocation.allocate_batch(bids, num_slots)
+        competing_bids = self.allocation.competing_bids(bids, num_slots)
+        slot_mask = winners >= 0
+        slot_rows = np.nonzero(slot_mask)[0]
+        slot_winners = winners[slot_mask]
+
+        # Determine click and conversion outcomes for the winning slots
+        clicks = self.clicks_rng.binomial(1, CTRs[slot_rows, slot_winners]).astype(bool)
+        conversions = np.zeros_like(clicks)
+        conversions[clicks] = self.conversions_rng.random(clicks.sum()) < self.fixed_cvr
+
+        # Scatter slot outcomes back onto the (round x participant) grid.
+        # Winners are distinct within a round, so every participant wins at most one slot.
+        won = np.zeros((num_rounds, num_participants), dtype=bool)
+        prices = np.zeros((num_rounds, num_participants))
+        second_prices = np.zeros((num_rounds, num_participants))
+        outcomes = np.zeros((num_rounds, num_participants), dtype=bool)
+        converted = np.zeros((num_rounds, num_participants), dtype=bool)
+        won[slot_rows, slot_winners] = True
+        prices[slot_rows, slot_winners] = slot_prices[slot_mask]
+        second_prices[slot_rows, slot_winners] = slot_second_prices[slot_mask]
+        outcomes[slot_rows, slot_winners] = clicks
+        converted[slot_rows, slot_winners] = conversions
+        self.revenue += slot_prices[slot_mask].sum()
+
+        # Write the outcomes into the agents' logs in bulk
+        for agent_idx, (rows, cols) in agent2rows.items():
+            agent_converted = converted[rows, cols]
+            self.agents[agent_idx].charge_batch(best_expected_values[rows, cols],
+                                                CTRs[rows, cols],
+                                                prices[rows, cols],
+                                                second_prices[rows, cols],
+                                                competing_bids[rows, cols],
+                                                outcomes[rows, cols],
+                                                won[rows, cols],
+                                                agent_converted,
+                                                agent_converted * self.fixed_sales_revenue_per_conversion)
 
     def clear_revenue(self):
         self.revenue = 0.0
@@ -8,6 +8,67 @@ class AllocationMechanism:
     def allocate(self, bids, num_slots):
         pass
 
+    def allocate_batch(self, bids, num_slots):
+        ''' Allocate every row of an (auctions x participants) bid matrix.
+            Returns (auctions x max_slots) arrays, where unused slots have a winner index of -1 '''
+        num_auctions = bids.shape[0]
+        num_slots = np.broadcast_to(num_slots, (num_auctions,))
+        max_slots = int(np.max(num_slots))
+        winners = np.full((num_auctions, max_slots), -1)
+        prices = np.zeros((num_auctions, max_slots))
+        second_prices = np.zeros((num_auctions, max_slots))
+        for row in range(num_auctions):
+            row_winners, row_prices, row_second_prices = self.allocate(bids[row], num_slots[row])
+            winners[row, :len(row_winners)] = row_winners
+            prices[row, :len(row_prices)] = row_prices
+            second_prices[row, :len(row_second_prices)] = row_second_prices
+        return winners, prices, second_prices
+
+    @staticmethod
+    def rank_top_bids(bids, num_slots):
+        ''' Partially rank every row of an (auctions x participants) bid matrix.
+            Only the top (max_slots + 1) bids per row are selected and sorted, which is all a
+            generalised first- or second-price auction needs.
+            Returns the winners (-1 for unused slots), the (max_slots + 1) highest bids in
+            decreasing order (0 where a row has fewer participants) and a mask of used slots. '''
+        num_auctions, num_participants = bids.shape
+        num_slots = np.broadcast_to(num_slots, (num_auctions,))
+        max_slots = int(np.max(num_slots))
+        num_ranked = min(max_slots + 1, num_participants)
+
+        # Select the top bids per row without sorting the rest
+        if num_ranked < num_participants:
+            top = np.argpartition(-bids, num_ranked - 1, axis=1)[:, :num_ranked]
+        else:
+            top = np.broadcast_to(np.arange(num_participants), (num_auctions, num_participants))
+        top_bids = np.take_along_axis(bids, top, axis=1)
+
+        # Sort only the selected bids
+        order = np.argsort(-top_bids, axis=1)
+        ranked = np.full((num_auctions, max_slots + 1), -1)
+        ranked_bids = np.zeros((num_auctions, max_slots + 1))
+        ranked[:, :num_ranked] = np.take_along_axis(top, order, axis=1)
+        ranked_bids[:, :num_ranked] = np.take_along_axis(top_bids, order, axis=1)
+
+        # Slots beyond the number offered in an auction, or beyond its number of participants, are unused
+        slot_mask = (np.arange(max_slots) < num_slots.reshape(-1, 1)) & (ranked[:, :-1] >= 0)
+        winners = np.where(slot_mask, ranked[:, :-1], -1)
+        return winners, ranked_bids, slot_mask
+
+    @classmethod
+    def competing_bids(cls, bids, num_slots):
+        ''' For every cell of an (auctions x participants) bid matrix, the lowest bid that would have won that
+            participant a slot against the other bids: the `num_slots`-th highest of them, or 0 if there are fewer.
+            This is the same for any rank-based allocation, so P(win | bid) is the CDF of these values. '''
+        num_auctions = bids.shape[0]
+        num_slots = np.broadcast_to(num_slots, (num_auctions,))
+        winners, ranked_bids, slot_mask = cls.rank_top_bids(bids, num_slots)
+        won = np.zeros(bids.shape, dtype=bool)
+        won[np.nonzero(slot_mask)[0], winners[slot_mask]] = True
+        # A winner competes against the highest losing bid, a loser against the lowest winning one
+        rows = np.arange(num_auctions)
+        return np.where(won, ranked_bids[rows, num_slots].reshape(-1, 1), ranked_bids[rows, num_slots - 1].reshape(-1, 1))
+
 
 class FirstPrice(AllocationMechanism):
     ''' (Generalised) First-Price Allocation '''
@@ -22,6 +83,12 @@ class FirstPrice(AllocationMechanism):
         second_prices = sorted_bids[1:num_slots+1]
         return winners, prices, second_prices
 
+    def allocate_batch(self, bids, num_slots):
+        winners, ranked_bids, slot_mask = self.rank_top_bids(bids, num_slots)
+        prices = np.where(slot_mask, ranked_bids[:, :-1], 0.0)
+        second_prices = np.where(slot_mask, ranked_bids[:, 1:], 0.0)
+        return winners, prices, second_prices
+
 
 class SecondPrice(AllocationMechanism):
     ''' (Generalised) Second-Price Allocation '''
@@ -33,3 +100,8 @@ class SecondPrice(AllocationMechanism):
         winners = np.argsort(-bids)[:num_slots]
         prices = -np.sort(-bids)[1:num_slots+1]
         return winners, prices, prices
+
+    def allocate_batch(self, bids, num_slots):
+        winners, ranked_bids, slot_mask = self.rank_top_bids(bids, num_slots)
+        prices = np.where(slot_mask, ranked_bids[:, 1:], 0.0)
+        return winners, prices, prices
@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import scipy.stats
 import torch
@@ -6,10 +5,18 @@ import torch
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import RBF
 from sklearn.metrics import roc_auc_score
-from tqdm import tqdm
 
-from Impression import ImpressionOpportunity
-from Models import BidShadingContextualBandit, BidShadingPolicy, PyTorchWinRateEstimator
+from Diagnostics import DiagnosticRecord
+from Impression import ShadingLog
+from Models import BidLandscape, BidShadingContextualBandit, BidShadingPolicy, PyTorchWinRateEstimator
+from Trainer import Trainer
+
+
+def sample_gaussian_gammas(rng, mean, sigma, size):
+    ''' Shading factors drawn from N(mean, sigma), with their densities as propensities '''
+    gammas = rng.normal(mean, sigma, size=size)
+    propensities = np.exp(-((mean - gammas) / sigma)**2/2) / (sigma * np.sqrt(2 * np.pi))
+    return gammas, propensities
 
 
 class Bidder:
@@ -17,12 +24,46 @@ class Bidder:
     def __init__(self, rng):
         self.rng = rng
         self.truthful = False # Default
+        # Shading factors and propensities drawn at bid time, one row per logged impression
+        self.shading_log = ShadingLog()
+        # Training loop settings, and statistics of the last fit of every model
+        self.trainer = Trainer()
+        self.training_stats = {}
+        # Diagnostics recorded by `update` when asked to plot, for `Plotting` to render
+        self.diagnostics = []
+
+    @property
+    def gammas(self):
+        return self.shading_log.gammas
+
+    @property
+    def propensities(self):
+        return self.shading_log.propensities
+
+    def bid_batch(self, values, contexts, estimated_CTRs):
+        ''' Bid on a block of impressions at once, logging them like `bid` does.
+            Returns the bids, and the shading factors and propensities they were drawn with.
+            Falls back to the scalar bidding path. '''
+        num_logged = len(self.shading_log)
+        bids = np.array([self.bid(value, context, estimated_CTR) for value, context, estimated_CTR in zip(values, contexts, estimated_CTRs)], dtype=np.float64)
+        if len(self.shading_log) == num_logged:
+            # Nothing was shaded
+            return bids, np.ones_like(bids), np.ones_like(bids)
+        rows = self.shading_log.last(len(bids))
+        return bids, self.shading_log.read('gamma', rows), self.shading_log.read('propensity', rows)
+
+    def observe_competing_bids(self, competing_bids):
+        ''' Called before every `update` with the lowest winning bid of every logged impression '''
+        pass
+
+    def record_diagnostic(self, kind, title, iteration, **data):
+        self.diagnostics.append(DiagnosticRecord(kind, title, iteration, data))
 
     def update(self, contexts, values, bids, prices, outcomes, estimated_CTRs, won_mask, iteration, plot, figsize, fontsize, name):
         pass
 
     def clear_logs(self, memory):
-        pass
+        self.shading_log.clear(keep=memory)
 
 
 class TruthfulBidder(Bidder):
@@ -34,14 +75,21 @@ class TruthfulBidder(Bidder):
     def bid(self, value, context, estimated_CTR):
         return value * estimated_CTR
 
+    def bid_batch(self, values, contexts, estimated_CTRs):
+        bids = values * estimated_CTRs
+        return bids, np.ones_like(bids), np.ones_like(bids)
+
 
 class EmpiricalShadedBidder(Bidder):
     """ A bidder that learns a single bidding factor gamma from past data """
 
-    def __init__(self, rng, gamma_sigma, init_gamma=1.0):
+    def __init__(self, rng, gamma_sigma, init_gamma=1.0, grid_delta=.005, smoothing_bandwidth=None):
         self.gamma_sigma = gamma_sigma
         self.prev_gamma = init_gamma
-        self.gammas = []
+        # Width of the shading factor buckets utility is estimated in
+        self.grid_delta = grid_delta
+        # Optional bandwidth of a Gaussian kernel that pools neighbouring buckets, in units of gamma
+        self.smoothing_bandwidth = smoothing_bandwidth
         super(EmpiricalShadedBidder, self).__init__(rng)
 
     def bid(self, value, context, estimated_CTR):
@@ -54,59 +102,74 @@ class EmpiricalShadedBidder(Bidder):
         if gamma > 1.0:
             gamma = 1.0
         bid *= gamma
-        self.gammas.append(gamma)
+        self.shading_log.append(gamma)
         return bid
 
+    def bid_batch(self, values, contexts, estimated_CTRs):
+        gammas = np.clip(self.rng.normal(self.prev_gamma, self.gamma_sigma, size=len(values)), 0.0, 1.0)
+        propensities = np.ones_like(gammas)
+        self.shading_log.extend(gammas, propensities)
+        return values * estimated_CTRs * gammas, gammas, propensities
+
+    def bucket_utilities(self, gammas, utilities):
+        ''' Split [min(gammas), max(gammas)] into buckets of width `grid_delta`, each covering [lo, hi).
+            Returns the bucket centres and the mean utility in every bucket with its standard error --
+            NaN where a bucket holds fewer than two samples. Every statistic is a `bincount` over the samples' bucket indices.
+            With a `smoothing_bandwidth`, every bucket instead pools the samples around it with Gaussian kernel weights. '''
+        min_gamma, max_gamma = np.min(gammas), np.max(gammas)
+        num_buckets = int((max_gamma-min_gamma) // self.grid_delta) + 1
+        buckets = np.linspace(min_gamma, max_gamma, num_buckets)
+        x = (buckets[1:] - buckets[:-1]) / 2.0 + buckets[:-1]
+
+        # Bucket index of every sample -- samples at max_gamma close no bucket, and are left out
+        idx = np.searchsorted(buckets, gammas, side='right') - 1
+        in_range = idx < num_buckets - 1
+        idx, utilities = idx[in_range], utilities[in_range]
+        counts = np.bincount(idx, minlength=num_buckets - 1).astype(np.float64)
+        sums = np.bincount(idx, weights=utilities, minlength=num_buckets - 1)
+
+        if self.smoothing_bandwidth is None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = sums / counts
+                # Two passes, like np.std
+                variance = np.bincount(idx, weights=(utilities - mean[idx])**2, minlength=num_buckets - 1) / counts
+                stderr = np.sqrt(variance / counts)
+            effective_counts = counts
+        else:
+            # Pool the per-bucket sufficient statistics with a truncated Gaussian kernel over bucket offsets
+            squares = np.bincount(idx, weights=utilities**2, minlength=num_buckets - 1)
+            width = self.smoothing_bandwidth / (buckets[1] - buckets[0]) if num_buckets > 1 else 1.0
+            offsets = np.arange(-int(np.ceil(4 * width)), int(np.ceil(4 * width)) + 1)
+            kernel = np.exp(-(offsets / width)**2 / 2)
+            smooth = lambda a, k=kernel: np.convolve(a, k)[offsets[-1]:offsets[-1] + len(a)]
+            weights, weighted_sums, weighted_squares = smooth(counts), smooth(sums), smooth(squares)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = weighted_sums / weights
+                variance = np.maximum(weighted_squares / weights - mean**2, 0.0)
+                # Kish's effective sample size of the kernel-weighted samples
+                effective_counts = weights**2 / smooth(counts, kernel**2)
+                stderr = np.sqrt(variance / effective_counts)
+
+        # Only draw inferences from buckets with more than one sample
+        mean[~(effective_counts > 1)] = np.nan
+        stderr[~(effective_counts > 1)] = np.nan
+        return x, mean, stderr
+
     def update(self, contexts, values, bids, prices, outcomes, estimated_CTRs, won_mask, iteration, plot, figsize, fontsize, name):
         # Compute net utility
         utilities = np.zeros_like(values)
         utilities[won_mask] = (values[won_mask] * outcomes[won_mask]) - prices[won_mask]
 
         # Extract shading factors to numpy
-        gammas = np.array(self.gammas)
+        gammas = self.gammas
 
         if plot:
-            _,_=plt.subplots(figsize=figsize)
-            plt.title('Raw observations',fontsize=fontsize+2)
-            plt.scatter(gammas,utilities, alpha=.25)
-            plt.xlabel(r'Shading factor ($\gamma$)',fontsize=fontsize)
-            plt.ylabel('Net Utility',fontsize=fontsize)
-            plt.xticks(fontsize=fontsize-2)
-            plt.yticks(fontsize=fontsize-2)
-            # plt.show()
+            self.record_diagnostic('scatter', 'Raw observations', iteration, x=gammas.copy(), y=utilities,
+                                   xlabel=r'Shading factor ($\gamma$)', ylabel='Net Utility')
 
         # We want to be able to estimate utility for any other continuous value, but this is a hassle in continuous space.
         # Instead -- we'll bucketise and look at the empirical utility distribution within every bucket
-        min_gamma, max_gamma = np.min(gammas), np.max(gammas)
-        grid_delta = .005
-        num_buckets = int((max_gamma-min_gamma) // grid_delta) + 1
-        buckets = np.linspace(min_gamma, max_gamma, num_buckets)
-        x = []
-        estimated_y_mean = []
-        estimated_y_stderr = []
-        bucket_lo = buckets[0]
-        for idx, bucket_hi in enumerate(buckets[1:]):
-            # Mean of the bucket
-            x.append((bucket_hi-bucket_lo)/2.0 + bucket_lo)
-            # Only look at samples within this range
-            mask = np.logical_and(gammas < bucket_hi, bucket_lo <= gammas)
-            # If we can draw meaningful inferences
-            num_samples = len(utilities[mask])
-            if num_samples > 1:
-                # Extrapolate mean utility from these samples
-                bucket_utility = utilities[mask].mean()
-                estimated_y_mean.append(bucket_utility)
-                # Compute standard error on utility estimate
-                estimated_y_stderr.append(np.std(utilities[mask]) / np.sqrt(num_samples))
-            else:
-                estimated_y_mean.append(np.nan)
-                estimated_y_stderr.append(np.nan)
-            # Move sliding window for bucket
-            bucket_lo = bucket_hi
-        # To NumPy format
-        x = np.asarray(x)
-        estimated_y_mean = np.asarray(estimated_y_mean)
-        estimated_y_stderr = np.asarray(estimated_y_stderr)
+        x, estimated_y_mean, estimated_y_stderr = self.bucket_utilities(gammas, utilities)
 
         # This is relatively high because we underestimate total variance
         # (1) Variance from click ~ Bernoulli(p)
@@ -125,49 +188,39 @@ class EmpiricalShadedBidder(Bidder):
         self.prev_gamma = best_gamma
 
         if plot:
-            fig, axes = plt.subplots(figsize=figsize)
-            plt.suptitle(name, fontsize=fontsize+2)
-            plt.title(f'Iteration: {iteration}', fontsize=fontsize)
-            plt.plot(x, estimated_y_mean, label='Estimate', ls='--', color='red')
-            plt.fill_between(x,
-                             estimated_y_mean - critical_value * estimated_y_stderr,
-                             estimated_y_mean + critical_value * estimated_y_stderr,
-                             alpha=.25,
-                             color='red',
-                             label='C.I.')
-            plt.axvline(best_gamma, ls='--', color='gray', label='Best')
-            plt.axhline(0, ls='-.', color='gray')
-            plt.xlabel(r'Multiplicative Bid Shading Factor ($\gamma$)', fontsize=fontsize)
-            plt.ylabel('Estimated Net Utility', fontsize=fontsize)
-            plt.ylim(-1.0, 2.0)
-            plt.xticks(fontsize=fontsize-2)
-            plt.yticks(fontsize=fontsize-2)
-            plt.legend(fontsize=fontsize)
-            plt.tight_layout()
-            #plt.show()
-
-    def clear_logs(self, memory):
-        if not memory:
-            self.gammas = []
-        else:
-            self.gammas = self.gammas[-memory:]
+            self.record_diagnostic('estimate', name, iteration, x=x, mean=estimated_y_mean,
+                                   lower=estimated_y_mean - critical_value * estimated_y_stderr,
+                                   upper=estimated_y_mean + critical_value * estimated_y_stderr,
+                                   best=best_gamma, ylim=(-1.0, 2.0),
+                                   xlabel=r'Multiplicative Bid Shading Factor ($\gamma$)', ylabel='Estimated Net Utility')
 
 
 class ValueLearningBidder(Bidder):
     """ A bidder that estimates the optimal bid shading distribution via value learning """
 
-    def __init__(self, rng, gamma_sigma, init_gamma=1.0, inference='search'):
+    def __init__(self, rng, gamma_sigma, init_gamma=1.0, inference='search', search_method='grid', winrate_solver='adam', winrate_model='logistic'):
         self.gamma_sigma = gamma_sigma
         self.prev_gamma = init_gamma
         assert inference in ['search', 'policy']
         self.inference = inference
-        self.gammas = []
-        self.propensities = []
-        self.winrate_model = PyTorchWinRateEstimator()
+        # 'grid' scores 128 random shading factors per bid, 'root' solves for the utility-maximising one exactly
+        assert search_method in ['grid', 'root']
+        self.search_method = search_method
+        # 'adam' runs first-order epochs until the loss plateaus, 'newton' solves for the same logistic regression exactly
+        assert winrate_solver in ['adam', 'newton']
+        self.winrate_solver = winrate_solver
+        # 'logistic' learns P(win | P(click), value, gamma), 'landscape' reads P(win | bid) off the observed competing bids
+        assert winrate_model in ['logistic', 'landscape']
+        self.bid_landscape = winrate_model == 'landscape'
+        self.winrate_model = BidLandscape() if self.bid_landscape else PyTorchWinRateEstimator()
         self.bidding_policy = BidShadingPolicy() if inference == 'policy' else None
         self.model_initialised = False
         super(ValueLearningBidder, self).__init__(rng)
 
+    def observe_competing_bids(self, competing_bids):
+        if self.bid_landscape:
+            self.winrate_model.fit(competing_bids)
+
     def bid(self, value, context, estimated_CTR):
         # Compute the bid as expected value
         bid = value * estimated_CTR
@@ -177,6 +230,10 @@ class ValueLearningBidder(Bidder):
             gamma = self.rng.normal(self.prev_gamma, self.gamma_sigma)
             normal_pdf = lambda g: np.exp(-((self.prev_gamma - g) / self.gamma_sigma)**2/2) / (self.gamma_sigma * np.sqrt(2 * np.pi))
             propensity = normal_pdf(gamma)
+        elif self.inference == 'search' and self.search_method == 'root':
+            # Option 2, in closed form: the utility-maximising gamma under the win-rate model
+            gamma = self.winrate_model.utility_maximising_gamma(estimated_CTR, value)[0]
+            propensity = 1.0
         elif self.inference == 'search':
             # Option 2:
             # Predict P(win|gamma,value,P(click))
@@ -186,7 +243,8 @@ class ValueLearningBidder(Bidder):
             gamma_grid.sort()
             x = torch.Tensor(np.hstack((np.tile(estimated_CTR, (n_values_search, 1)), np.tile(value, (n_values_search, 1)), gamma_grid.reshape(-1,1))))
 
-            prob_win = self.winrate_model(x).detach().numpy().ravel()
+            with torch.no_grad():
+                prob_win = self.winrate_model(x).numpy().ravel()
 
             # U = W (V - P)
             expected_value = bid
@@ -200,13 +258,43 @@ class ValueLearningBidder(Bidder):
             x = torch.Tensor([estimated_CTR, value])
             with torch.no_grad():
                 gamma, propensity = self.bidding_policy(x)
-                gamma = gamma.detach().item()
+            gamma, propensity = gamma.item(), propensity.item()
 
         bid *= gamma
-        self.gammas.append(gamma)
-        self.propensities.append(propensity)
+        self.shading_log.append(float(gamma), float(propensity))
         return bid
 
+    def bid_batch(self, values, contexts, estimated_CTRs):
+        # Compute the bids as expected values
+        expected_values = values * estimated_CTRs
+        if not self.model_initialised:
+            gammas, propensities = sample_gaussian_gammas(self.rng, self.prev_gamma, self.gamma_sigma, len(values))
+        elif self.inference == 'search' and self.search_method == 'root':
+            gammas = self.winrate_model.utility_maximising_gamma(estimated_CTRs, values)
+            propensities = np.ones_like(gammas)
+        elif self.inference == 'search':
+            # A sorted random grid of candidate shading factors per impression, all scored in one forward pass
+            n_values_search = 128
+            gamma_grid = np.sort(self.rng.uniform(0.1, 1.0, size=(len(values), n_values_search)), axis=1)
+            x = torch.Tensor(np.stack((np.broadcast_to(estimated_CTRs.reshape(-1, 1), gamma_grid.shape),
+                                       np.broadcast_to(values.reshape(-1, 1), gamma_grid.shape),
+                                       gamma_grid), axis=-1).reshape(-1, 3))
+            with torch.no_grad():
+                prob_win = self.winrate_model(x).numpy().reshape(gamma_grid.shape)
+
+            # U = W (V - P)
+            estimated_utility = prob_win * (expected_values.reshape(-1, 1) * (1.0 - gamma_grid))
+            gammas = gamma_grid[np.arange(len(values)), np.argmax(estimated_utility, axis=1)]
+            propensities = np.ones_like(gammas)
+        elif self.inference == 'policy':
+            x = torch.Tensor(np.column_stack((estimated_CTRs, values)))
+            with torch.no_grad():
+                gammas, propensities = self.bidding_policy(x)
+            gammas, propensities = gammas.numpy().ravel().astype(np.float64), propensities.numpy().ravel().astype(np.float64)
+
+        self.shading_log.extend(gammas, propensities)
+        return expected_values * gammas, gammas, propensities
+
     def update(self, contexts, values, bids, prices, outcomes, estimated_CTRs, won_mask, iteration, plot, figsize, fontsize, name):
         # FALLBACK: if you lost every auction you participated in, your model collapsed
         # Revert to not shading for 1 round, to collect data with informational value
@@ -222,7 +310,7 @@ class ValueLearningBidder(Bidder):
 
         # Augment data with samples: if you shade 100%, you will lose
         # If you won now, you would have also won if you bid higher
-        X = np.hstack((estimated_CTRs.reshape(-1,1), values.reshape(-1,1), np.array(self.gammas).reshape(-1, 1)))
+        X = np.hstack((estimated_CTRs.reshape(-1,1), values.reshape(-1,1), self.gammas.reshape(-1, 1)))
 
         X_aug_neg = X.copy()
         X_aug_neg[:, -1] = 0.0
@@ -236,42 +324,27 @@ class ValueLearningBidder(Bidder):
         y = torch.Tensor(np.concatenate((y, np.zeros_like(y))))
 
         # Fit the model
-        self.winrate_model.train()
-        epochs = 8192 * 4
-        lr = 3e-3
-        optimizer = torch.optim.Adam(self.winrate_model.parameters(), lr=lr, weight_decay=1e-6, amsgrad=True)
-        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=100, min_lr=1e-7, factor=0.1, verbose=True)
-        criterion = torch.nn.BCELoss()
-        losses = []
-        best_epoch, best_loss = -1, np.inf
-        for epoch in tqdm(range(int(epochs)), desc=f'{name}'):
-            optimizer.zero_grad()
-            pred_y = self.winrate_model(X)
-            loss = criterion(pred_y, y)
-            loss.backward()
-            optimizer.step()
-            losses.append(loss.item())
-            scheduler.step(loss)
-            if (best_loss - losses[-1]) > 1e-6:
-                best_epoch = epoch
-                best_loss = losses[-1]
-            elif epoch - best_epoch > 512:
-                print(f'Stopping at Epoch {epoch}')
-                break
-
-        losses = np.array(losses)
-
+        if self.bid_landscape:
+            # Already indexed from the competing bids in `observe_competing_bids`
+            pass
+        elif self.winrate_solver == 'newton':
+            self.winrate_model.fit_newton(X, y, weight_decay=1e-6)
+        else:
+            self.winrate_model.train()
+            epochs = 8192 * 4
+            lr = 3e-3
+            optimizer = self.trainer.optimizer('winrate_model', lambda: torch.optim.Adam(self.winrate_model.parameters(), lr=lr, weight_decay=1e-6, amsgrad=True))
+            scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=100, min_lr=1e-7, factor=0.1)
+            criterion = torch.nn.BCELoss()
+            loss_fn = lambda rows: criterion(self.winrate_model(X[rows]), y[rows])
+            stats = self.trainer.fit(loss_fn, optimizer, epochs, patience=512, num_samples=len(y), scheduler=scheduler, name=name)
+            self.training_stats['winrate_model'] = stats
+            if plot:
+                self.record_diagnostic('loss', name, iteration, losses=stats.losses, label=r'P(win|$\gamma$,x)', ylabel='Loss')
         self.winrate_model.eval()
-        fig, ax = plt.subplots()
-        plt.title(f'{name}')
-        plt.plot(losses, label=r'P(win|$gamma$,x)')
-        plt.ylabel('Loss')
-        plt.legend()
-        fig.set_tight_layout(True)
-        # plt.show()
 
         # Predict Utility -- \hat{u}
-        orig_features = torch.Tensor(np.hstack((estimated_CTRs.reshape(-1,1), values.reshape(-1,1), np.array(self.gammas).reshape(-1, 1))))
+        orig_features = torch.Tensor(np.hstack((estimated_CTRs.reshape(-1,1), values.reshape(-1,1), self.gammas.reshape(-1, 1))))
         W = self.winrate_model(orig_features).squeeze().detach().numpy()
         print('AUC predicting P(win):\t\t\t\t', roc_auc_score(won_mask.astype(np.uint8), W))
 
@@ -282,56 +355,31 @@ class ValueLearningBidder(Bidder):
             self.bidding_policy.train()
             epochs = 8192 * 2
             lr = 2e-3
-            optimizer = torch.optim.Adam(self.bidding_policy.parameters(), lr=lr, weight_decay=1e-6, amsgrad=True)
-            scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=100, min_lr=1e-7, factor=0.1, verbose=True)
-            losses = []
-            best_epoch, best_loss = -1, np.inf
-            for epoch in tqdm(range(int(epochs)), desc=f'{name}'):
-                optimizer.zero_grad()
+            optimizer = self.trainer.optimizer('bidding_policy', lambda: torch.optim.Adam(self.bidding_policy.parameters(), lr=lr, weight_decay=1e-6, amsgrad=True))
+            scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=100, min_lr=1e-7, factor=0.1)
+
+            def negative_estimated_utility(rows):
                 # Sample bid shading values
-                sampled_gamma, propensities = self.bidding_policy(X)
+                sampled_gamma, propensities = self.bidding_policy(X[rows])
 
                 # Add them to input for win probability model
-                X_with_gamma = torch.hstack((X, sampled_gamma))
+                X_with_gamma = torch.hstack((X[rows], sampled_gamma))
 
                 # Estimate utility for these sampled bid shading values
                 prob_win = self.winrate_model(X_with_gamma).squeeze()
                 values = X_with_gamma[:, 0].squeeze() * X_with_gamma[:, 1].squeeze()
                 prices = values * sampled_gamma.squeeze()
 
-                estimated_utility = -(prob_win * (values - prices)).mean()
-                estimated_utility.backward()
-                optimizer.step()
+                return -(prob_win * (values - prices)).mean()
 
-                losses.append(estimated_utility.item())
-                scheduler.step(estimated_utility)
-                if (best_loss - losses[-1]) > 1e-6:
-                    best_epoch = epoch
-                    best_loss = losses[-1]
-                elif epoch - best_epoch > 256:
-                    print(f'Stopping at Epoch {epoch}')
-                    break
-
-            losses = np.array(losses)
+            stats = self.trainer.fit(negative_estimated_utility, optimizer, epochs, patience=256, num_samples=len(X), scheduler=scheduler, name=name)
+            self.training_stats['bidding_policy'] = stats
             self.bidding_policy.eval()
-            fig, ax = plt.subplots()
-            plt.title(f'{name}')
-            plt.plot(losses, label=r'$\pi(\gamma)$')
-            plt.ylabel('- Estimated Expected Utility')
-            plt.legend()
-            fig.set_tight_layout(True)
-            #plt.show()
+            if plot:
+                self.record_diagnostic('loss', name, iteration, losses=stats.losses, label=r'$\pi(\gamma)$', ylabel='- Estimated Expected Utility')
 
         self.model_initialised = True
 
-    def clear_logs(self, memory):
-        if not memory:
-            self.gammas = []
-            self.propensities = []
-        else:
-            self.gammas = self.gammas[-memory:]
-            self.propensities = self.propensities[-memory:]
-
 
 class PolicyLearningBidder(Bidder):
     """ A bidder that estimates the optimal bid shading distribution via policy learning """
@@ -339,8 +387,6 @@ class PolicyLearningBidder(Bidder):
     def __init__(self, rng, gamma_sigma, loss, init_gamma=1.0, reward_function_type="net_utility"):
         self.gamma_sigma = gamma_sigma
         self.prev_gamma = init_gamma
-        self.gammas = []
-        self.propensities = []
         self.model = BidShadingContextualBandit(loss)
         self.model_initialised = False
         self.reward_function_type = reward_function_type
@@ -359,14 +405,29 @@ class PolicyLearningBidder(Bidder):
             # Option 2:
             # Sample from the contextual bandit
             x = torch.Tensor([estimated_CTR, value])
-            gamma, propensity = self.model(x)
-            gamma = torch.clip(gamma, 0.0, 1.0)
+            with torch.no_grad():
+                gamma, propensity = self.model(x)
+            # Plain floats -- logging tensors would keep their graphs alive until the next update
+            gamma, propensity = min(max(gamma.item(), 0.0), 1.0), propensity.item()
 
-        bid *= gamma.detach().item() if self.model_initialised else gamma
-        self.gammas.append(gamma)
-        self.propensities.append(propensity)
+        bid *= gamma
+        self.shading_log.append(float(gamma), float(propensity))
         return bid
 
+    def bid_batch(self, values, contexts, estimated_CTRs):
+        if not self.model_initialised:
+            gammas, propensities = sample_gaussian_gammas(self.rng, self.prev_gamma, self.gamma_sigma, len(values))
+        else:
+            # Sample from the contextual bandit, for every impression at once
+            x = torch.Tensor(np.column_stack((estimated_CTRs, values)))
+            with torch.no_grad():
+                gammas, propensities = self.model(x)
+            gammas = np.clip(gammas.numpy().ravel().astype(np.float64), 0.0, 1.0)
+            propensities = propensities.numpy().ravel().astype(np.float64)
+
+        self.shading_log.extend(gammas, propensities)
+        return values * estimated_CTRs * gammas, gammas, propensities
+
     def update(self, contexts, values, bids, prices, outcomes, estimated_CTRs, won_mask, iteration, plot, figsize, fontsize, name):
         # Compute rewards based on reward function type
         raw_rewards_np = np.zeros_like(values)
@@ -398,41 +459,31 @@ class PolicyLearningBidder(Bidder):
         utilities = torch.Tensor(raw_rewards_np)
 
         # Extract shading factors to torch
-        gammas = torch.Tensor(self.gammas)
+        gammas = torch.as_tensor(self.gammas, dtype=torch.float32)
 
         # Prepare features
         X = torch.Tensor(np.hstack((estimated_CTRs.reshape(-1,1), values.reshape(-1,1))))
 
         if not self.model_initialised:
-            self.model.initialise_policy(X, gammas)
+            self.training_stats['initial_policy'] = self.model.initialise_policy(X, gammas, self.trainer)
+            if plot:
+                self.record_diagnostic('loss', 'Initialising policy', iteration, losses=self.training_stats['initial_policy'].losses,
+                                       label='Loss', ylabel='MSE with logging policy')
 
         # Ensure we don't have propensities that are rounded to zero
-        propensities = torch.clip(torch.Tensor(self.propensities), min=1e-15)
+        propensities = torch.clip(torch.as_tensor(self.propensities, dtype=torch.float32), min=1e-15)
 
         # Fit the model
         self.model.train()
         epochs = 8192 * 2
         lr = 2e-3
-        optimizer = torch.optim.Adam(self.model.parameters(), lr=lr, weight_decay=1e-4, amsgrad=True)
+        optimizer = self.trainer.optimizer('model', lambda: torch.optim.Adam(self.model.parameters(), lr=lr, weight_decay=1e-4, amsgrad=True))
         scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=100, min_lr=1e-8, factor=0.2)
-        losses = []
-        best_epoch, best_loss = -1, np.inf
-        for epoch in tqdm(range(int(epochs)), desc=f'{name}'):
-            optimizer.zero_grad()  # Setting our stored gradients equal to zero
-            loss = self.model.loss(X, gammas, propensities, utilities, importance_weight_clipping_eps=50.0)
-            loss.backward()  # Computes the gradient of the given tensor w.r.t. the weights/bias
-            optimizer.step()  # Updates weights and biases with the optimizer (SGD)
-            losses.append(loss.item())
-            scheduler.step(loss)
-
-            if (best_loss - losses[-1]) > 1e-6:
-                best_epoch = epoch
-                best_loss = losses[-1]
-            elif epoch - best_epoch > 512:
-                print(f'Stopping at Epoch {epoch}')
-                break
-
-        losses = np.array(losses)
+        loss_fn = lambda rows: self.model.loss(X[rows], gammas[rows], propensities[rows], utilities[rows], importance_weight_clipping_eps=50.0)
+        stats = self.trainer.fit(loss_fn, optimizer, epochs, patience=512, num_samples=len(X), scheduler=scheduler, name=name)
+        self.training_stats['model'] = stats
+
+        losses = stats.losses
         if np.isnan(losses).any():
             print('NAN DETECTED! in losses')
             print(list(losses))
@@ -454,28 +505,28 @@ class PolicyLearningBidder(Bidder):
         self.model_initialised = True
         self.model.model_initialised = True
 
-    def clear_logs(self, memory):
-        if not memory:
-            self.gammas = []
-            self.propensities = []
-        else:
-            self.gammas = self.gammas[-memory:]
-            self.propensities = self.propensities[-memory:]
-
 
 class DoublyRobustBidder(Bidder):
     """ A bidder that estimates the optimal bid shading distribution with a Doubly Robust Estimator """
 
-    def __init__(self, rng, gamma_sigma, init_gamma=1.0):
+    def __init__(self, rng, gamma_sigma, init_gamma=1.0, winrate_solver='adam', winrate_model='logistic'):
         self.gamma_sigma = gamma_sigma
         self.prev_gamma = init_gamma
-        self.gammas = []
-        self.propensities = []
-        self.winrate_model = PyTorchWinRateEstimator()
+        # 'adam' runs first-order epochs until the loss plateaus, 'newton' solves for the same logistic regression exactly
+        assert winrate_solver in ['adam', 'newton']
+        self.winrate_solver = winrate_solver
+        # 'logistic' learns P(win | P(click), value, gamma), 'landscape' reads P(win | bid) off the observed competing bids
+        assert winrate_model in ['logistic', 'landscape']
+        self.bid_landscape = winrate_model == 'landscape'
+        self.winrate_model = BidLandscape() if self.bid_landscape else PyTorchWinRateEstimator()
         self.bidding_policy = BidShadingContextualBandit(loss='Doubly Robust', winrate_model=self.winrate_model)
         self.model_initialised = False
         super(DoublyRobustBidder, self).__init__(rng)
 
+    def observe_competing_bids(self, competing_bids):
+        if self.bid_landscape:
+            self.winrate_model.fit(competing_bids)
+
     def bid(self, value, context, estimated_CTR):
         # Compute the bid as expected value
         bid = value * estimated_CTR
@@ -491,13 +542,26 @@ class DoublyRobustBidder(Bidder):
             x = torch.Tensor([estimated_CTR, value])
             with torch.no_grad():
                 gamma, propensity = self.bidding_policy(x)
-                gamma = torch.clip(gamma, 0.0, 1.0)
+            gamma, propensity = min(max(gamma.item(), 0.0), 1.0), propensity.item()
 
-        bid *= gamma.detach().item() if self.model_initialised else gamma
-        self.gammas.append(gamma)
-        self.propensities.append(propensity)
+        bid *= gamma
+        self.shading_log.append(float(gamma), float(propensity))
         return bid
 
+    def bid_batch(self, values, contexts, estimated_CTRs):
+        if not self.model_initialised:
+            gammas, propensities = sample_gaussian_gammas(self.rng, self.prev_gamma, self.gamma_sigma, len(values))
+        else:
+            # Sample from the contextual bandit, for every impression at once
+            x = torch.Tensor(np.column_stack((estimated_CTRs, values)))
+            with torch.no_grad():
+                gammas, propensities = self.bidding_policy(x)
+            gammas = np.clip(gammas.numpy().ravel().astype(np.float64), 0.0, 1.0)
+            propensities = propensities.numpy().ravel().astype(np.float64)
+
+        self.shading_log.extend(gammas, propensities)
+        return values * estimated_CTRs * gammas, gammas, propensities
+
     def update(self, contexts, values, bids, prices, outcomes, estimated_CTRs, won_mask, iteration, plot, figsize, fontsize, name):
         # Compute net utility
         utilities = np.zeros_like(values)
@@ -507,7 +571,7 @@ class DoublyRobustBidder(Bidder):
         ##############################
         # 1. TRAIN UTILITY ESTIMATOR #
         ##############################
-        gammas_numpy = np.array([g.detach().item() if self.model_initialised else g for g in self.gammas])
+        gammas_numpy = self.gammas
         if self.model_initialised:
             # Predict Utility -- \hat{u}
             orig_features = torch.Tensor(np.hstack((estimated_CTRs.reshape(-1,1), values.reshape(-1,1), gammas_numpy.reshape(-1, 1))))
@@ -538,30 +602,20 @@ class DoublyRobustBidder(Bidder):
         y = torch.Tensor(np.concatenate((y, np.zeros_like(y))))
 
         # Fit the model
-        self.winrate_model.train()
-        epochs = 8192 * 4
-        lr = 3e-3
-        optimizer = torch.optim.Adam(self.winrate_model.parameters(), lr=lr, weight_decay=1e-6, amsgrad=True)
-        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=256, min_lr=1e-7, factor=0.2, verbose=True)
-        criterion = torch.nn.BCELoss()
-        losses = []
-        best_epoch, best_loss = -1, np.inf
-        for epoch in tqdm(range(int(epochs)), desc=f'{name}'):
-            optimizer.zero_grad()
-            pred_y = self.winrate_model(X)
-            loss = criterion(pred_y, y)
-            loss.backward()
-            optimizer.step()
-            losses.append(loss.item())
-            scheduler.step(loss)
-            if (best_loss - losses[-1]) > 1e-6:
-                best_epoch = epoch
-                best_loss = losses[-1]
-            elif epoch - best_epoch > 1024:
-                print(f'Stopping at Epoch {epoch}')
-                break
-
-        losses = np.array(losses)
+        if self.bid_landscape:
+            # Already indexed from the competing bids in `observe_competing_bids`
+            pass
+        elif self.winrate_solver == 'newton':
+            self.winrate_model.fit_newton(X, y, weight_decay=1e-6)
+        else:
+            self.winrate_model.train()
+            epochs = 8192 * 4
+            lr = 3e-3
+            optimizer = self.trainer.optimizer('winrate_model', lambda: torch.optim.Adam(self.winrate_model.parameters(), lr=lr, weight_decay=1e-6, amsgrad=True))
+            scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=256, min_lr=1e-7, factor=0.2)
+            criterion = torch.nn.BCELoss()
+            loss_fn = lambda rows: criterion(self.winrate_model(X[rows]), y[rows])
+            self.training_stats['winrate_model'] = self.trainer.fit(loss_fn, optimizer, epochs, patience=1024, num_samples=len(y), scheduler=scheduler, name=name)
 
         self.winrate_model.eval()
 
@@ -583,42 +637,31 @@ class DoublyRobustBidder(Bidder):
         ##############################
         utilities = torch.Tensor(utilities)
         estimated_utilities = torch.Tensor(estimated_utilities)
-        gammas = torch.Tensor(self.gammas)
+        gammas = torch.as_tensor(self.gammas, dtype=torch.float32)
 
         # Prepare features
         X = torch.Tensor(np.hstack((estimated_CTRs.reshape(-1,1), values.reshape(-1,1))))
 
         if not self.model_initialised:
-            self.bidding_policy.initialise_policy(X, gammas)
+            self.training_stats['initial_policy'] = self.bidding_policy.initialise_policy(X, gammas, self.trainer)
+            if plot:
+                self.record_diagnostic('loss', 'Initialising policy', iteration, losses=self.training_stats['initial_policy'].losses,
+                                       label='Loss', ylabel='MSE with logging policy')
 
         # Ensure we don't have propensities that are rounded to zero
-        propensities = torch.clip(torch.Tensor(self.propensities), min=1e-15)
+        propensities = torch.clip(torch.as_tensor(self.propensities, dtype=torch.float32), min=1e-15)
 
         # Fit the model
         self.bidding_policy.train()
         epochs = 8192 * 4
         lr = 7e-3
-        optimizer = torch.optim.Adam(self.bidding_policy.parameters(), lr=lr, weight_decay=1e-4, amsgrad=True)
-        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=100, min_lr=1e-8, factor=0.2, threshold=5e-3, verbose=True)
-
-        losses = []
-        best_epoch, best_loss = -1, np.inf
-        for epoch in tqdm(range(int(epochs)), desc=f'{name}'):
-            optimizer.zero_grad()  # Setting our stored gradients equal to zero
-            loss = self.bidding_policy.loss(X, gammas, propensities, utilities, utility_estimates=estimated_utilities, winrate_model=self.winrate_model, importance_weight_clipping_eps=50.0)
-            loss.backward()  # Computes the gradient of the given tensor w.r.t. the weights/bias
-            optimizer.step()  # Updates weights and biases with the optimizer (SGD)
-            losses.append(loss.item())
-            scheduler.step(loss)
-
-            if (best_loss - losses[-1]) > 1e-6:
-                best_epoch = epoch
-                best_loss = losses[-1]
-            elif epoch - best_epoch > 512:
-                print(f'Stopping at Epoch {epoch}')
-                break
-
-        losses = np.array(losses)
+        optimizer = self.trainer.optimizer('bidding_policy', lambda: torch.optim.Adam(self.bidding_policy.parameters(), lr=lr, weight_decay=1e-4, amsgrad=True))
+        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=100, min_lr=1e-8, factor=0.2, threshold=5e-3)
+        loss_fn = lambda rows: self.bidding_policy.loss(X[rows], gammas[rows], propensities[rows], utilities[rows], utility_estimates=estimated_utilities[rows], winrate_model=self.winrate_model, importance_weight_clipping_eps=50.0)
+        stats = self.trainer.fit(loss_fn, optimizer, epochs, patience=512, num_samples=len(X), scheduler=scheduler, name=name)
+        self.training_stats['bidding_policy'] = stats
+
+        losses = stats.losses
         if np.isnan(losses).any():
             print('NAN DETECTED! in losses')
             print(list(losses))
@@ -637,11 +680,3 @@ class DoublyRobustBidder(Bidder):
 
         self.model_initialised = True
         self.bidding_policy.model_initialised = True
-
-    def clear_logs(self, memory):
-        if not memory:
-            self.gammas = []
-            self.propensities = []
-        else:
-            self.gammas = self.gammas[-memory:]
-            self.propensities = self.propensities[-memory:]
@@ -1,30 +1,73 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 from sklearn.metrics import log_loss, roc_auc_score
 from sklearn.model_selection import train_test_split
-from tqdm import tqdm
 
-from Models import PyTorchLogisticRegression, sigmoid
+from Models import PyTorchLogisticRegression, online_logistic_update, sigmoid
+from Trainer import Trainer
 
 
 class Allocator:
     """ Base class for an allocator """
 
+    # Online allocators learn from every observed outcome through `observe`, rather than at iteration boundaries
+    online = False
+
     def __init__(self, rng):
         self.rng = rng
+        # Training loop settings, and statistics of the last fit of every model
+        self.trainer = Trainer()
+        self.training_stats = {}
 
     def update(self, contexts, items, outcomes, iteration, plot, figsize, fontsize, name):
         pass
 
+    def observe(self, contexts, items, outcomes):
+        pass
+
+    def estimate_CTR_batch(self, contexts, sample=True):
+        return np.vstack([self.estimate_CTR(context, sample=sample) for context in contexts])
+
+    def estimate_CTR_and_MAP(self, context):
+        ''' Posterior-sampled and MAP CTRs for all items '''
+        return self.estimate_CTR(context), self.estimate_CTR(context, sample=False)
+
+    def estimate_CTR_batch_and_MAP(self, contexts):
+        ''' Posterior-sampled and MAP CTRs for all items, for every context '''
+        return self.estimate_CTR_batch(contexts), self.estimate_CTR_batch(contexts, sample=False)
+
 
 class PyTorchLogisticRegressionAllocator(Allocator):
-    """ An allocator that estimates P(click) with Logistic Regression implemented in PyTorch"""
+    """ An allocator that estimates P(click) with Logistic Regression implemented in PyTorch.
+        The model is trained in PyTorch, but inference runs on NumPy copies of its posterior, refreshed after every update. """
 
-    def __init__(self, rng, embedding_size, num_items, thompson_sampling=True):
+    # Number of posterior samples' worth of standard normal noise drawn at once for Thompson sampling
+    NOISE_POOL_SIZE = 4096
+
+    def __init__(self, rng, embedding_size, num_items, thompson_sampling=True, solver='adam'):
         self.response_model = PyTorchLogisticRegression(n_dim=embedding_size, n_items=num_items)
         self.thompson_sampling = thompson_sampling
+        # 'adam' runs first-order epochs until the loss plateaus, 'newton' solves for the same MAP estimate exactly
+        assert solver in ('adam', 'newton'), f'Unknown solver: {solver}'
+        self.solver = solver
         super(PyTorchLogisticRegressionAllocator, self).__init__(rng)
+        self.noise_pool = np.empty((0, num_items, embedding_size + 1))
+        self.noise_cursor = 0
+        self.refresh_posterior()
+
+    def refresh_posterior(self):
+        ''' Cache the posterior mean and standard deviation as NumPy arrays, for inference '''
+        self.m = self.response_model.m.detach().numpy().astype(np.float64)
+        self.posterior_std = 1.0 / np.sqrt(self.response_model.q.numpy().astype(np.float64))
+
+    def draw_noise(self, num_samples):
+        ''' Standard normal noise for `num_samples` posterior samples, handed out from a pre-drawn pool '''
+        if self.noise_cursor + num_samples > len(self.noise_pool):
+            self.noise_pool = self.rng.standard_normal((max(self.NOISE_POOL_SIZE, num_samples),) + self.m.shape)
+            self.noise_cursor = 0
+        noise = self.noise_pool[self.noise_cursor:self.noise_cursor + num_samples]
+        self.noise_cursor += num_samples
+        return noise
 
     def update(self, contexts, items, outcomes, iteration, plot, figsize, fontsize, name):
         # Rename
@@ -34,38 +77,85 @@ class PyTorchLogisticRegressionAllocator(Allocator):
             return
 
         # Fit the model
+        if self.solver == 'newton':
+            self.response_model.fit_newton(torch.Tensor(X), torch.LongTensor(A), torch.Tensor(y))
+        else:
+            self.fit_adam(X, A, y, name)
+
+        # Laplace Approximation for variance q, in one pass over the data for all items
+        with torch.no_grad():
+            self.response_model.laplace_approx_batch(torch.Tensor(X), torch.LongTensor(A))
+            self.response_model.update_prior()
+
+        self.response_model.eval()
+        self.refresh_posterior()
+
+    def fit_adam(self, X, A, y, name):
         self.response_model.train()
         epochs = 8192 * 2
         lr = 2e-3
-        optimizer = torch.optim.Adam(self.response_model.parameters(), lr=lr)
+        optimizer = self.trainer.optimizer('response_model', lambda: torch.optim.Adam(self.response_model.parameters(), lr=lr))
         scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', factor=0.5)
 
         X, A, y = torch.Tensor(X), torch.LongTensor(A), torch.Tensor(y)
-        losses = []
-        for epoch in tqdm(range(int(epochs)), desc=f'{name}'):
-            optimizer.zero_grad()  # Setting our stored gradients equal to zero
-            loss = self.response_model.loss(torch.squeeze(self.response_model.predict_item(X, A)), y)
-            loss.backward()  # Computes the gradient of the given tensor w.r.t. the weights/bias
-            optimizer.step()  # Updates weights and biases with the optimizer (SGD)
-            losses.append(loss.item())
-            scheduler.step(loss)
-
-            if epoch > 1024 and np.abs(losses[-100] - losses[-1]) < 1e-6:
-                print(f'Stopping at Epoch {epoch}')
-                break
-
-        # Laplace Approximation for variance q
-        with torch.no_grad():
-            for item in range(self.response_model.m.shape[0]):
-                item_mask = items == item
-                X_item = torch.Tensor(contexts[item_mask])
-                self.response_model.laplace_approx(X_item, item)
-            self.response_model.update_prior()
+        # The log loss is a sum over samples, so a minibatch carries its share of the prior
+        loss_fn = lambda rows: self.response_model.loss(torch.squeeze(self.response_model.predict_item(X[rows], A[rows]), dim=-1), y[rows], prior_weight=len(y[rows]) / len(y))
+        self.training_stats['response_model'] = self.trainer.fit(loss_fn, optimizer, epochs, patience=100, num_samples=len(y), scheduler=scheduler, min_epochs=1024, name=name)
 
-        self.response_model.eval()
+    def estimate_CTR(self, context, sample=True):
+        if self.thompson_sampling and sample:
+            return self.estimate_CTR_and_MAP(context)[0]
+        return sigmoid(self.m @ context)
+
+    def estimate_CTR_batch(self, contexts, sample=True):
+        if self.thompson_sampling and sample:
+            return self.estimate_CTR_batch_and_MAP(contexts)[0]
+        return sigmoid(contexts @ self.m.T)
+
+    def estimate_CTR_and_MAP(self, context):
+        ''' A posterior sample shifts the MAP logits by (noise * std) . x, so both come out of one evaluation '''
+        MAP_logits = self.m @ context
+        if not self.thompson_sampling:
+            CTRs = sigmoid(MAP_logits)
+            return CTRs, CTRs
+        noise_logits = (self.draw_noise(1)[0] * self.posterior_std) @ context
+        return sigmoid(MAP_logits + noise_logits), sigmoid(MAP_logits)
+
+    def estimate_CTR_batch_and_MAP(self, contexts):
+        MAP_logits = contexts @ self.m.T
+        if not self.thompson_sampling:
+            CTRs = sigmoid(MAP_logits)
+            return CTRs, CTRs
+        noise_logits = np.einsum('nd,nkd->nk', contexts, self.draw_noise(len(contexts)) * self.posterior_std)
+        return sigmoid(MAP_logits + noise_logits), sigmoid(MAP_logits)
+
+
+class OnlineLogisticRegressionAllocator(Allocator):
+    """ An allocator that estimates P(click) with Bayesian Logistic Regression, updated online after every won impression.
+        Follows the online Thompson sampling scheme of Chapelle & Li: the posterior is a diagonal Gaussian N(m, 1/q)
+        per item, and every observation updates it in O(d) -- there is no retraining on the logged history. """
+
+    online = True
+
+    def __init__(self, rng, embedding_size, num_items, thompson_sampling=True, prior_precision=1.0):
+        self.m = np.zeros((num_items, embedding_size + 1))
+        self.q = np.full((num_items, embedding_size + 1), float(prior_precision))
+        self.thompson_sampling = thompson_sampling
+        super(OnlineLogisticRegressionAllocator, self).__init__(rng)
+
+    def observe(self, contexts, items, outcomes):
+        online_logistic_update(self.m, self.q, np.asarray(contexts, dtype=np.float64),
+                               np.asarray(items, dtype=np.int64), np.asarray(outcomes, dtype=np.float64))
 
     def estimate_CTR(self, context, sample=True):
-        return self.response_model(torch.from_numpy(context.astype(np.float32)), sample=(self.thompson_sampling and sample)).detach().numpy()
+        return self.estimate_CTR_batch(np.asarray(context).reshape(1, -1), sample=sample)[0]
+
+    def estimate_CTR_batch(self, contexts, sample=True):
+        if self.thompson_sampling and sample:
+            # An independent posterior sample per context
+            weights = self.m + self.rng.standard_normal((len(contexts),) + self.m.shape) / np.sqrt(self.q)
+            return sigmoid(np.einsum('nd,nkd->nk', contexts, weights))
+        return sigmoid(contexts @ self.m.T)
 
 
 class OracleAllocator(Allocator):
@@ -80,3 +170,6 @@ class OracleAllocator(Allocator):
 
     def estimate_CTR(self, context):
         return sigmoid(self.item_embeddings @ context)
+
+    def estimate_CTR_batch(self, contexts, sample=True):
+        return sigmoid(contexts @ self.item_embeddings.T)
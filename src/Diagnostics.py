@@ -0,0 +1,13 @@
+from dataclasses import dataclass, field
+
+
+@dataclass
+class DiagnosticRecord:
+    ''' The data behind one diagnostic figure, recorded by a model update and rendered later by `Plotting`.
+        Updates only fill these in -- they never touch matplotlib. '''
+    # 'scatter', 'estimate' or 'loss' -- how `Plotting.DiagnosticPlotter` draws the record
+    kind: str
+    title: str
+    iteration: int
+    # Arrays to draw, and labels
+    data: dict = field(default_factory=dict)
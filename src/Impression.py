@@ -26,6 +26,7 @@ class ImpressionOpportunity(_ImpressionSlotsBase):
     won: np.bool_
     conversion: bool = field(default=False)
     sales_revenue: np.float32 = field(default=0.0)
+    competing_bid: np.float32 = field(default=0.0)
 
     def set_true_CTR(self, best_expected_value, true_CTR):
         self.best_expected_value = best_expected_value  # Best possible CTR (to compute regret from ad allocation)
@@ -43,3 +44,193 @@ class ImpressionOpportunity(_ImpressionSlotsBase):
     def set_conversion_details(self, converted: bool, revenue: float):
         self.conversion = converted
         self.sales_revenue = revenue
+
+
+class RingBuffer:
+    ''' Growable circular buffer of named columns.
+        Rows are appended at the tail and written by logical index. `clear(keep)` retains the most recent rows
+        by moving the head, so nothing is copied and later rows overwrite dropped ones in place. Once the capacity
+        covers the retained window plus one iteration of new rows, the buffer stops allocating. '''
+
+    # Column name : dtype -- the trailing shape of a column is taken from its first write
+    COLUMNS = {}
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.head = 0
+        self.size = 0
+        self.columns = {name: None for name in self.COLUMNS}
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, num_rows):
+        if self.size + num_rows <= self.capacity:
+            return
+        # Grow geometrically and unwrap the logged rows to the front
+        capacity = max(2 * self.capacity, self.size + num_rows)
+        for name, column in self.columns.items():
+            grown = np.zeros((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:self.size] = self._ordered(column)
+            self.columns[name] = grown
+        self.capacity = capacity
+        self.head = 0
+
+    def _ordered(self, column):
+        ''' Logged rows of a column in insertion order -- a view, unless the rows wrap around the end '''
+        end = self.head + self.size
+        if end <= self.capacity:
+            return column[self.head:end]
+        return np.concatenate((column[self.head:], column[:end - self.capacity]))
+
+    def _physical(self, idx):
+        ''' Pairs of (buffer slice, row slice) covering a logical index or contiguous slice '''
+        if not isinstance(idx, slice):
+            idx = idx + self.size if idx < 0 else idx
+            if not 0 <= idx < self.size:
+                raise IndexError(f'{type(self).__name__} index out of range')
+            idx = slice(idx, idx + 1)
+        start, stop, _ = idx.indices(self.size)
+        num_rows = stop - start
+        start = (self.head + start) % self.capacity
+        if start + num_rows <= self.capacity:
+            return [(slice(start, start + num_rows), slice(0, num_rows))]
+        first = self.capacity - start
+        return [(slice(start, self.capacity), slice(0, first)), (slice(0, num_rows - first), slice(first, num_rows))]
+
+    def write(self, name, idx, values):
+        ''' Write one row, or a contiguous slice of rows, of a column '''
+        column = self.columns[name]
+        values = np.asarray(values)
+        for physical, rows in self._physical(idx):
+            column[physical] = values[rows] if isinstance(idx, slice) and values.ndim else values
+
+    def read(self, name, idx):
+        ''' Read one row, or a contiguous slice of rows, of a column -- slices are views unless they wrap around '''
+        column = self.columns[name]
+        pieces = self._physical(idx)
+        if not isinstance(idx, slice):
+            return column[pieces[0][0].start]
+        if len(pieces) == 1:
+            return column[pieces[0][0]]
+        return np.concatenate([column[physical] for physical, _ in pieces])
+
+    def extend_rows(self, **columns):
+        ''' Append a block of rows -- columns that are not given are zeroed. Returns the slice they occupy '''
+        num_rows = len(next(iter(columns.values())))
+        for name, dtype in self.COLUMNS.items():
+            if self.columns[name] is None:
+                row_shape = np.shape(columns[name])[1:] if name in columns else ()
+                self.columns[name] = np.zeros((self.capacity,) + row_shape, dtype=dtype)
+        self._reserve(num_rows)
+        rows = slice(self.size, self.size + num_rows)
+        self.size += num_rows
+        for name in self.COLUMNS:
+            self.write(name, rows, columns.get(name, 0))
+        return rows
+
+    def last(self, num_rows):
+        return slice(self.size - num_rows, self.size)
+
+    def column(self, name):
+        if self.columns[name] is None:
+            return np.zeros(0, dtype=self.COLUMNS[name])
+        return self._ordered(self.columns[name])
+
+    def clear(self, keep=0):
+        ''' Drop all but the last `keep` rows '''
+        keep = min(keep, self.size)
+        if self.capacity:
+            self.head = (self.head + self.size - keep) % self.capacity
+        self.size = keep
+
+
+class ImpressionLog(RingBuffer):
+    ''' Struct-of-arrays log of impression opportunities.
+        Columns are preallocated float32/int/bool arrays plus a 2-D context block. Column properties return
+        the logged rows in order, as zero-copy views unless the retained window wraps around the buffer. '''
+
+    COLUMNS = {
+        'context': np.float32,
+        'item': np.int32,
+        'value': np.float32,
+        'bid': np.float32,
+        'best_expected_value': np.float32,
+        'true_CTR': np.float32,
+        'estimated_CTR': np.float32,
+        'price': np.float32,
+        'second_price': np.float32,
+        'outcome': np.bool_,
+        'won': np.bool_,
+        'conversion': np.bool_,
+        'sales_revenue': np.float32,
+        # The lowest bid that would have won a slot against the other participants' bids
+        'competing_bid': np.float32,
+    }
+
+    def append(self, context, item, value, bid, estimated_CTR):
+        ''' Log a new opportunity -- the remaining fields are filled out once the auction is resolved '''
+        return self.extend(np.asarray(context).reshape(1, -1), [item], [value], [bid], [estimated_CTR]).start
+
+    def extend(self, contexts, items, values, bids, estimated_CTRs):
+        ''' Log a block of new opportunities, returns the slice they occupy '''
+        return self.extend_rows(context=contexts, item=items, value=values, bid=bids, estimated_CTR=estimated_CTRs)
+
+    def set_true_CTR(self, idx, best_expected_value, true_CTR):
+        self.write('best_expected_value', idx, best_expected_value)  # Best possible CTR (to compute regret from ad allocation)
+        self.write('true_CTR', idx, true_CTR)  # True CTR for the chosen ad
+
+    def set_price_outcome(self, idx, price, second_price, outcome, won=True):
+        self.write('price', idx, price)
+        self.write('second_price', idx, second_price)
+        self.write('outcome', idx, outcome)
+        self.write('won', idx, won)
+
+    def set_price(self, idx, price):
+        self.write('price', idx, price)
+
+    def set_conversion_details(self, idx, converted, revenue):
+        self.write('conversion', idx, converted)
+        self.write('sales_revenue', idx, revenue)
+
+    def set_competing_bid(self, idx, competing_bid):
+        self.write('competing_bid', idx, competing_bid)
+
+    def __getitem__(self, idx):
+        return ImpressionOpportunity(**{name: self.read(name, idx) for name in self.COLUMNS})
+
+    def __iter__(self):
+        return (self[idx] for idx in range(self.size))
+
+    contexts = property(lambda self: self.column('context'))
+    items = property(lambda self: self.column('item'))
+    values = property(lambda self: self.column('value'))
+    bids = property(lambda self: self.column('bid'))
+    best_expected_values = property(lambda self: self.column('best_expected_value'))
+    true_CTRs = property(lambda self: self.column('true_CTR'))
+    estimated_CTRs = property(lambda self: self.column('estimated_CTR'))
+    prices = property(lambda self: self.column('price'))
+    second_prices = property(lambda self: self.column('second_price'))
+    outcomes = property(lambda self: self.column('outcome'))
+    won = property(lambda self: self.column('won'))
+    conversions = property(lambda self: self.column('conversion'))
+    sales_revenues = property(lambda self: self.column('sales_revenue'))
+    competing_bids = property(lambda self: self.column('competing_bid'))
+
+
+class ShadingLog(RingBuffer):
+    ''' Log of the shading factors and propensities a bidder drew at bid time, aligned with its agent's ImpressionLog '''
+
+    COLUMNS = {
+        'gamma': np.float64,
+        'propensity': np.float64,
+    }
+
+    def append(self, gamma, propensity=1.0):
+        return self.extend_rows(gamma=[gamma], propensity=[propensity]).start
+
+    def extend(self, gammas, propensities=1.0):
+        return self.extend_rows(gamma=gammas, propensity=np.broadcast_to(propensities, np.shape(gammas)))
+
+    gammas = property(lambda self: self.column('gamma'))
+    propensities = property(lambda self: self.column('propensity'))
@@ -1,16 +1,106 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 from numba import jit
 from scipy.optimize import minimize
 from torch.nn import functional as F
-from tqdm import tqdm
+
+from Trainer import Trainer
 
 
 @jit(nopython=True)
 def sigmoid(x):
     return 1.0 / (1.0 + np.exp(-x))
 
+
+def newton_logistic_regression(X, y, m, prior_mean, prior_precision, max_iter=100, tol=1e-10):
+    ''' MAP estimate of a logistic regression with a diagonal Gaussian prior, by damped Newton-Raphson (IRLS).
+        Minimises  sum(log loss) + 0.5 * sum(prior_precision * (m - prior_mean)**2)  starting from `m`.
+        The objective is convex, so a handful of Newton steps with step halving reach the optimum.
+        Works in float64 and returns the estimate in the dtype of `m`. '''
+    dtype = m.dtype
+    X, y = X.double(), y.double()
+    m, mu, precision = m.detach().double().clone(), prior_mean.detach().double(), prior_precision.detach().double()
+    # A tiny ridge keeps the Hessian invertible when a feature is constant and unregularised
+    ridge = 1e-9 * torch.eye(len(m), dtype=torch.float64)
+
+    def objective(m):
+        z = X @ m
+        return (F.softplus(z) - y * z).sum() + 0.5 * (precision * (m - mu)**2).sum()
+
+    value = objective(m)
+    for _ in range(max_iter):
+        P = torch.sigmoid(X @ m)
+        gradient = X.T @ (P - y) + precision * (m - mu)
+        hessian = (X.T * (P * (1 - P))) @ X + torch.diag(precision) + ridge
+        step = torch.linalg.solve(hessian, gradient)
+        decrement = gradient @ step
+        if decrement / 2 <= tol:
+            break
+        # Backtracking line search on the Armijo condition
+        t = 1.0
+        while True:
+            candidate = m - t * step
+            candidate_value = objective(candidate)
+            if candidate_value <= value - 1e-4 * t * decrement or t < 1e-10:
+                break
+            t /= 2
+        m, value = candidate, candidate_value
+    return m.to(dtype)
+
+@jit(nopython=True)
+def online_logistic_update(m, q, X, A, y, max_newton_steps=10):
+    ''' Fold observations one at a time into a diagonal Gaussian posterior N(m, 1/q) over per-item logistic regression weights.
+        Updates `m` and `q` in place, with O(d) work per observation.
+
+        The new mode maximises log N(w; m, 1/q) + log P(y | x.w). It lies on the line w = m + t * x / q, so a 1-D Newton
+        search over the score z = x.w finds it: with s = x.m and v = sum(x^2 / q), the objective in z is
+        (z - s)^2 / 2v + logloss(y, z). The precision then gains the log-loss curvature at the new mode, sigma(1 - sigma) x^2. '''
+    for n in range(X.shape[0]):
+        a = A[n]
+        s = 0.0
+        v = 0.0
+        for i in range(X.shape[1]):
+            s += X[n, i] * m[a, i]
+            v += X[n, i] * X[n, i] / q[a, i]
+        if v == 0.0:
+            continue
+
+        z = s
+        for _ in range(max_newton_steps):
+            p = 1.0 / (1.0 + np.exp(-z))
+            step = ((z - s) / v + p - y[n]) / (1.0 / v + p * (1.0 - p))
+            z -= step
+            if abs(step) < 1e-10:
+                break
+
+        p = 1.0 / (1.0 + np.exp(-z))
+        for i in range(X.shape[1]):
+            m[a, i] += (z - s) / v * X[n, i] / q[a, i]
+            q[a, i] += p * (1.0 - p) * X[n, i] * X[n, i]
+
+
+@jit(nopython=True)
+def logistic_utility_argmax(offsets, slope, min_gamma, max_gamma, num_bisections=50):
+    ''' argmax over gamma in [min_gamma, max_gamma] of sigmoid(offset + slope * gamma) * (1 - gamma), for every offset.
+        The derivative has the sign of h(gamma) = slope * (1 - gamma) * (1 - sigmoid(offset + slope * gamma)) - 1.
+        For slope > 0, h decreases from h(min_gamma) to h(1) = -1, so the optimum is its single root -- found by bisection --
+        or `min_gamma` when h is already negative there. For slope <= 0, h < 0 everywhere and the optimum is `min_gamma`. '''
+    gammas = np.full(offsets.shape[0], min_gamma)
+    if slope <= 0.0:
+        return gammas
+    for n in range(offsets.shape[0]):
+        lo, hi = min_gamma, max_gamma
+        if slope * (1.0 - lo) / (1.0 + np.exp(offsets[n] + slope * lo)) - 1.0 <= 0.0:
+            continue
+        for _ in range(num_bisections):
+            mid = (lo + hi) / 2.0
+            if slope * (1.0 - mid) / (1.0 + np.exp(offsets[n] + slope * mid)) - 1.0 > 0.0:
+                lo = mid
+            else:
+                hi = mid
+        gammas[n] = (lo + hi) / 2.0
+    return gammas
+
 # This is an implementation of Algorithm 3 (Regularised Bayesian Logistic Regression with a Laplace Approximation)
 # from "An Empirical Evaluation of Thompson Sampling" by Olivier Chapelle & Lihong Li
 # https://proceedings.neurips.cc/paper/2011/file/e53a0a2978c28872a4505bdb51db06dc-Paper.pdf
@@ -25,28 +115,41 @@ class PyTorchLogisticRegression(torch.nn.Module):
         self.logloss = torch.nn.BCELoss(reduction='sum')
         self.eval()
 
-    def forward(self, x, sample=False):
-        ''' Predict outcome for all items, allow for posterior sampling '''
-        if sample:
-            return torch.sigmoid(F.linear(x, self.m + torch.normal(mean=0.0, std=1.0/torch.sqrt(self.q))))
-        else:
-            return torch.sigmoid(F.linear(x, self.m))
+    def forward(self, x):
+        ''' Predict outcome for all items with the MAP estimate -- posterior samples are drawn by the allocator '''
+        return torch.sigmoid(F.linear(x, self.m))
 
     def predict_item(self, x, a):
         ''' Predict outcome for an item a, only MAP '''
         return torch.sigmoid((x * self.m[a]).sum(axis=1))
 
-    def loss(self, predictions, labels):
+    def loss(self, predictions, labels, prior_weight=1.0):
         prior_dist = self.q[:, :-1] * (self.prev_iter_m[:, :-1] - self.m[:, :-1])**2
-        return 0.5 * prior_dist.sum() + self.logloss(predictions, labels)
+        return 0.5 * prior_weight * prior_dist.sum() + self.logloss(predictions, labels)
 
     def laplace_approx(self, X, item):
         P = (1 + torch.exp(1 - X.matmul(self.m[item, :].T))) ** (-1)
         self.q[item, :] += (P*(1-P)).T.matmul(X ** 2).squeeze(0)
 
+    def laplace_approx_batch(self, X, A):
+        ''' `laplace_approx` for all items at once -- every row's precision update is scattered onto the row's item '''
+        P = (1 + torch.exp(1 - (X * self.m[A]).sum(axis=1))) ** (-1)
+        self.q.index_add_(0, A, (P * (1 - P)).unsqueeze(1) * X ** 2)
+
     def update_prior(self):
         self.prev_iter_m = self.m.detach().clone()
 
+    def fit_newton(self, X, A, y):
+        ''' Fit the MAP estimate of every item with Newton-Raphson -- the same objective `loss` gives Adam '''
+        # The intercept is not regularised
+        prior_mask = torch.ones(self.m.shape[1])
+        prior_mask[-1] = 0.0
+        with torch.no_grad():
+            for item in torch.unique(A):
+                item_mask = A == item
+                self.m[item] = newton_logistic_regression(X[item_mask], y[item_mask], self.m[item],
+                                                          self.prev_iter_m[item], self.q[item] * prior_mask)
+
 
 class PyTorchWinRateEstimator(torch.nn.Module):
     def __init__(self):
@@ -61,6 +164,107 @@ class PyTorchWinRateEstimator(torch.nn.Module):
     def forward(self, x):
         return self.model(x)
 
+    def fit_newton(self, X, y, weight_decay=1e-6):
+        ''' Fit the logistic regression exactly with Newton-Raphson, starting from the current weights.
+            Minimises the mean log loss with L2 penalty `weight_decay` on all parameters -- what Adam is run on. '''
+        linear = self.model[0]
+        X = torch.hstack((X, torch.ones((X.shape[0], 1))))
+        with torch.no_grad():
+            m = torch.cat((linear.weight.ravel(), linear.bias))
+            # Newton minimises the summed log loss, so the penalty scales with the number of samples
+            m = newton_logistic_regression(X, y.ravel(), m, torch.zeros_like(m), torch.full_like(m, weight_decay * X.shape[0]))
+            linear.weight.copy_(m[:-1].reshape(linear.weight.shape))
+            linear.bias.copy_(m[-1:])
+
+    def utility_maximising_gamma(self, estimated_CTRs, values, min_gamma=0.1, max_gamma=1.0):
+        ''' The shading factor maximising P(win) * (1 - gamma) -- the estimated utility, up to the expected value -- for every row.
+            The model is logistic in (P(click), value, gamma), so this is a 1-D root find instead of a search. '''
+        weights = self.model[0].weight.detach().numpy().astype(np.float64).ravel()
+        bias = float(self.model[0].bias.detach())
+        offsets = weights[0] * np.asarray(estimated_CTRs, dtype=np.float64) + weights[1] * np.asarray(values, dtype=np.float64) + bias
+        return logistic_utility_argmax(np.atleast_1d(offsets), weights[2], min_gamma, max_gamma)
+
+
+@jit(nopython=True)
+def landscape_utility_argmax(expected_values, knots, cdf, min_gamma, max_gamma):
+    ''' argmax over gamma in [min_gamma, max_gamma] of F(gamma * V) * (1 - gamma), for every expected value V,
+        where F is piecewise linear through (knots, cdf) and flat outside them.
+        On a segment F(b) = a + s * b, so the utility (V - b) * F(b) is a concave quadratic in the bid. Its maximum is
+        at a segment end or at the stationary point b = (s * V - a) / 2s, so every segment is solved in closed form. '''
+    gammas = np.full(expected_values.shape[0], min_gamma)
+    for n in range(expected_values.shape[0]):
+        V = expected_values[n]
+        if V <= 0.0:
+            continue
+        lo, hi = min_gamma * V, max_gamma * V
+        # Below the first knot F is flat, so the lowest bid there is best
+        best_bid, best_utility = lo, -1.0
+        if lo <= knots[0]:
+            best_utility = (V - lo) * cdf[0]
+        for j in range(knots.shape[0] - 1):
+            start, stop = max(knots[j], lo), min(knots[j + 1], hi)
+            if start > stop:
+                continue
+            slope = (cdf[j + 1] - cdf[j]) / (knots[j + 1] - knots[j])
+            intercept = cdf[j] - slope * knots[j]
+            candidates = (start, stop, (slope * V - intercept) / (2.0 * slope) if slope > 0.0 else start)
+            for b in candidates:
+                b = min(max(b, start), stop)
+                utility = (V - b) * (intercept + slope * b)
+                if utility > best_utility:
+                    best_bid, best_utility = b, utility
+        # Above the last knot every bid wins, so the lowest bid there is best
+        b = max(knots[-1], lo)
+        if b <= hi and V - b > best_utility:
+            best_bid = b
+        gammas[n] = best_bid / V
+    return gammas
+
+
+class BidLandscape(torch.nn.Module):
+    ''' Non-parametric win-rate model: P(win | bid) is the empirical CDF of the competing bids an agent faced.
+        The CDF is kept at `num_knots` quantiles of the observed competing bids and interpolated linearly between them,
+        so a query is a binary search, and P(win) stays differentiable in the shading factor.
+        Takes the same (P(click), value, gamma) inputs as `PyTorchWinRateEstimator`, and needs no training loop. '''
+
+    def __init__(self, num_knots=256):
+        super(BidLandscape, self).__init__()
+        self.num_knots = num_knots
+        # Until competing bids are observed, every positive bid wins
+        self.register_buffer('knots', torch.tensor([0.0, 1e-9], dtype=torch.float64))
+        self.register_buffer('cdf', torch.tensor([0.0, 1.0], dtype=torch.float64))
+        self.eval()
+
+    def fit(self, competing_bids):
+        ''' Rebuild the index from the competing bids of the retained impressions '''
+        competing_bids = np.sort(np.asarray(competing_bids, dtype=np.float64))
+        if not len(competing_bids):
+            return
+        knots = np.unique(np.quantile(competing_bids, np.linspace(0.0, 1.0, self.num_knots)))
+        # The fraction of competing bids below every knot -- ties at a knot count as lost
+        cdf = np.searchsorted(competing_bids, knots, side='left') / len(competing_bids)
+        # Every competing bid is beaten just above the highest one
+        knots = np.append(knots, knots[-1] * (1.0 + 1e-6) + 1e-9)
+        cdf = np.append(cdf, 1.0)
+        self.knots, self.cdf = torch.from_numpy(knots), torch.from_numpy(cdf)
+
+    def win_probability(self, bids):
+        ''' P(win | bid) for an array of bids '''
+        return np.interp(bids, self.knots.numpy(), self.cdf.numpy())
+
+    def forward(self, x):
+        bids = (x[:, 0] * x[:, 1] * x[:, 2]).double().contiguous()
+        upper = torch.searchsorted(self.knots, bids).clamp(1, len(self.knots) - 1)
+        start, stop = self.knots[upper - 1], self.knots[upper]
+        weight = ((bids - start) / (stop - start)).clamp(0.0, 1.0)
+        prob_win = self.cdf[upper - 1] + weight * (self.cdf[upper] - self.cdf[upper - 1])
+        return prob_win.to(x.dtype).reshape(-1, 1)
+
+    def utility_maximising_gamma(self, estimated_CTRs, values, min_gamma=0.1, max_gamma=1.0):
+        ''' The shading factor maximising P(win) * (1 - gamma) for every row, solved exactly on every segment of the CDF '''
+        expected_values = np.atleast_1d(np.asarray(estimated_CTRs, dtype=np.float64) * np.asarray(values, dtype=np.float64))
+        return landscape_utility_argmax(expected_values, self.knots.numpy(), self.cdf.numpy(), min_gamma, max_gamma)
+
 
 class BidShadingPolicy(torch.nn.Module):
     def __init__(self):
@@ -107,7 +311,7 @@ class BidShadingContextualBandit(torch.nn.Module):
 
         self.model_initialised = False
 
-    def initialise_policy(self, observed_contexts, observed_gammas):
+    def initialise_policy(self, observed_contexts, observed_gammas, trainer=None):
         # The first time, train the policy to imitate the logging policy
         self.train()
         epochs = 8192 * 2
@@ -115,33 +319,23 @@ class BidShadingContextualBandit(torch.nn.Module):
         optimizer = torch.optim.Adam(self.parameters(), lr=lr, weight_decay=1e-4, amsgrad=True)
 
         criterion = torch.nn.MSELoss()
-        losses = []
-        best_epoch, best_loss = -1, np.inf
-        for epoch in tqdm(range(int(epochs)), desc=f'Initialising Policy'):
-            optimizer.zero_grad()  # Setting our stored gradients equal to zero
-            predicted_mu_gammas = torch.nn.Softplus()(self.mu_linear_out(torch.nn.Softplus()(self.shared_linear(observed_contexts))))
-            predicted_sigma_gammas = torch.nn.Softplus()(self.sigma_linear_out(torch.nn.Softplus()(self.shared_linear(observed_contexts))))
-            loss = criterion(predicted_mu_gammas.squeeze(), observed_gammas) + criterion(predicted_sigma_gammas.squeeze(), torch.ones_like(observed_gammas) * .05)
-            loss.backward()  # Computes the gradient of the given tensor w.r.t. the weights/bias
-            optimizer.step()  # Updates weights and biases with the optimizer (SGD)
-            losses.append(loss.item())
-            if (best_loss - losses[-1]) > 1e-6:
-                best_epoch = epoch
-                best_loss = losses[-1]
-            elif epoch - best_epoch > 512:
-                print(f'Stopping at Epoch {epoch}')
-                break
 
-        fig, ax = plt.subplots()
-        plt.title(f'Initialising policy')
-        plt.plot(losses, label=r'Loss')
-        plt.ylabel('MSE with logging policy')
-        plt.legend()
-        fig.set_tight_layout(True)
-        #plt.show()
+        def predict_mu_sigma(rows=slice(None)):
+            predicted_mu_gammas = torch.nn.Softplus()(self.mu_linear_out(torch.nn.Softplus()(self.shared_linear(observed_contexts[rows]))))
+            predicted_sigma_gammas = torch.nn.Softplus()(self.sigma_linear_out(torch.nn.Softplus()(self.shared_linear(observed_contexts[rows]))))
+            return predicted_mu_gammas, predicted_sigma_gammas
+
+        def loss_fn(rows):
+            predicted_mu_gammas, predicted_sigma_gammas = predict_mu_sigma(rows)
+            return criterion(predicted_mu_gammas.squeeze(-1), observed_gammas[rows]) + criterion(predicted_sigma_gammas.squeeze(-1), torch.ones_like(observed_gammas[rows]) * .05)
+
+        stats = (trainer or Trainer()).fit(loss_fn, optimizer, epochs, patience=512, num_samples=len(observed_gammas), name='Initialising Policy')
 
+        with torch.no_grad():
+            predicted_mu_gammas, predicted_sigma_gammas = predict_mu_sigma()
         print('Predicted mu Gammas: ', predicted_mu_gammas.min(), predicted_mu_gammas.max(), predicted_mu_gammas.mean())
         print('Predicted sigma Gammas: ', predicted_sigma_gammas.min(), predicted_sigma_gammas.max(), predicted_sigma_gammas.mean())
+        return stats
 
     def forward(self, x):
         x = self.shared_linear(x)
@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class ParticipantSampler:
+    ''' Samples the participants of auction rounds without replacement, optionally weighted by per-agent participation rates.
+
+        Weighted sampling is successive sampling: participants are drawn one at a time with probability proportional
+        to their rate among the agents not drawn yet (uniform if all rates are equal).
+        Small agent pools rank one random key per agent and round. Large pools draw a few more than `num_participants`
+        candidates per round with replacement and keep the first distinct ones, which costs O(k log k) per round
+        rather than O(number of agents). '''
+
+    def __init__(self, num_agents, num_participants, participation_rates=None, max_dense_agents=64):
+        assert num_participants <= num_agents, 'Cannot sample more participants than there are agents'
+        self.num_agents = num_agents
+        self.num_participants = num_participants
+
+        if participation_rates is None or np.all(np.asarray(participation_rates) == participation_rates[0]):
+            self.probabilities = None
+        else:
+            participation_rates = np.asarray(participation_rates, dtype=np.float64)
+            assert np.all(participation_rates > 0), 'Participation rates must be positive'
+            self.probabilities = participation_rates / participation_rates.sum()
+            self.cumulative_probabilities = np.cumsum(self.probabilities)
+            self.cumulative_probabilities[-1] = 1.0
+
+        # Rejection only pays off if duplicates are rare: many agents, none with a large share of the rate
+        max_probability = 1.0 / num_agents if self.probabilities is None else self.probabilities.max()
+        self.sparse = num_agents > max(max_dense_agents, 4 * num_participants) and num_participants * max_probability < .5
+        # Extra candidates drawn per round, so that most rounds need no redraw
+        self.num_candidates = num_participants + max(2, num_participants // 2)
+
+    def sample(self, rng, num_rounds=None):
+        ''' Participant indices for one round, or a (num_rounds x num_participants) matrix '''
+        if num_rounds is None:
+            if self.probabilities is None and not self.sparse:
+                return rng.choice(self.num_agents, self.num_participants, replace=False)
+            return self.sample(rng, 1)[0]
+        if self.sparse:
+            return self._sample_sparse(rng, num_rounds)
+        return self._sample_dense(rng, num_rounds)
+
+    def _sample_dense(self, rng, num_rounds):
+        uniforms = rng.random((num_rounds, self.num_agents))
+        if self.probabilities is None:
+            # Ranks of uniform keys
+            return np.argsort(uniforms, axis=1)[:, :self.num_participants]
+        # Gumbel-top-k as exponential races: the k smallest -log(u) / p form a successive sample weighted by p
+        keys = -np.log(uniforms) / self.probabilities
+        return np.argpartition(keys, self.num_participants - 1, axis=1)[:, :self.num_participants]
+
+    def _draw_candidates(self, rng, num_rounds):
+        uniforms = rng.random((num_rounds, self.num_candidates))
+        if self.probabilities is None:
+            return np.minimum((uniforms * self.num_agents).astype(np.int64), self.num_agents - 1)
+        return np.searchsorted(self.cumulative_probabilities, uniforms, side='right')
+
+    def _sample_sparse(self, rng, num_rounds):
+        participants = np.empty((num_rounds, self.num_participants), dtype=np.int64)
+        pending = np.arange(num_rounds)
+        candidates = self._draw_candidates(rng, num_rounds)
+        while True:
+            # Mark the first occurrence of every candidate within its row
+            order = np.argsort(candidates, axis=1, kind='stable')
+            sorted_candidates = np.take_along_axis(candidates, order, axis=1)
+            is_first = np.ones_like(candidates, dtype=bool)
+            is_first[:, 1:] = sorted_candidates[:, 1:] != sorted_candidates[:, :-1]
+            first_occurrence = np.empty_like(is_first)
+            np.put_along_axis(first_occurrence, order, is_first, axis=1)
+
+            # Keep the first `num_participants` distinct candidates of complete rows
+            keep = first_occurrence & (np.cumsum(first_occurrence, axis=1) <= self.num_participants)
+            complete = keep.sum(axis=1) == self.num_participants
+            participants[pending[complete]] = candidates[complete][keep[complete]].reshape(-1, self.num_participants)
+            if np.all(complete):
+                return participants
+            # Incomplete rows keep their draws and continue with more candidates -- redrawing them from scratch
+            # would only keep the rows that happened to finish early, and bias the sample against high-rate agents
+            pending = pending[~complete]
+            candidates = np.hstack((candidates[~complete], self._draw_candidates(rng, len(pending))))
@@ -0,0 +1,71 @@
+import numpy as np
+from matplotlib.figure import Figure
+
+
+def downsample(max_points, *arrays):
+    ''' Every k-th element of the arrays, with k chosen to keep at most `max_points` of them '''
+    stride = max(1, int(np.ceil(len(arrays[0]) / max_points)))
+    return [np.asarray(array)[::stride] for array in arrays]
+
+
+class DiagnosticPlotter:
+    ''' Renders the `DiagnosticRecord`s emitted by model updates to image files, without a display.
+        Every kind of record is drawn on one figure that is cleared and reused for every render. Figures are not
+        registered with pyplot, so nothing accumulates over iterations, agents and runs.
+        Scatters are downsampled to `max_points` points. '''
+
+    def __init__(self, figsize=(8, 5), fontsize=14, max_points=5000, dpi=100):
+        self.figsize = figsize
+        self.fontsize = fontsize
+        self.max_points = max_points
+        self.dpi = dpi
+        self.figures = {}
+
+    def render(self, record, path):
+        if record.kind not in self.figures:
+            self.figures[record.kind] = Figure(figsize=self.figsize, dpi=self.dpi)
+        figure = self.figures[record.kind]
+        figure.clear()
+        ax = figure.add_subplot()
+        getattr(self, f'draw_{record.kind}')(figure, ax, record)
+        figure.tight_layout()
+        figure.savefig(path)
+
+    def render_all(self, records, path_prefix):
+        ''' Render every record to `<path_prefix>_<index>_<kind>.png`, returns the paths written '''
+        paths = []
+        for idx, record in enumerate(records):
+            path = f'{path_prefix}_{idx}_{record.kind}.png'
+            self.render(record, path)
+            paths.append(path)
+        return paths
+
+    def label_axes(self, ax, data):
+        ax.set_xlabel(data.get('xlabel', ''), fontsize=self.fontsize)
+        ax.set_ylabel(data.get('ylabel', ''), fontsize=self.fontsize)
+        ax.tick_params(labelsize=self.fontsize-2)
+
+    def draw_scatter(self, figure, ax, record):
+        x, y = downsample(self.max_points, record.data['x'], record.data['y'])
+        ax.set_title(record.title, fontsize=self.fontsize+2)
+        ax.scatter(x, y, alpha=.25)
+        self.label_axes(ax, record.data)
+
+    def draw_estimate(self, figure, ax, record):
+        data = record.data
+        figure.suptitle(record.title, fontsize=self.fontsize+2)
+        ax.set_title(f'Iteration: {record.iteration}', fontsize=self.fontsize)
+        ax.plot(data['x'], data['mean'], label='Estimate', ls='--', color='red')
+        ax.fill_between(data['x'], data['lower'], data['upper'], alpha=.25, color='red', label='C.I.')
+        ax.axvline(data['best'], ls='--', color='gray', label='Best')
+        ax.axhline(0, ls='-.', color='gray')
+        if 'ylim' in data:
+            ax.set_ylim(*data['ylim'])
+        self.label_axes(ax, data)
+        ax.legend(fontsize=self.fontsize)
+
+    def draw_loss(self, figure, ax, record):
+        ax.set_title(record.title)
+        ax.plot(record.data['losses'], label=record.data['label'])
+        ax.set_ylabel(record.data.get('ylabel', 'Loss'))
+        ax.legend()
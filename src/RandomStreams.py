@@ -0,0 +1,113 @@
+import zlib
+
+import numpy as np
+
+
+class RandomStream:
+    ''' A stream of random numbers for a single purpose, pre-drawn in large blocks and handed out by cursor.
+        Offers the subset of the np.random.Generator interface that the simulator uses, so it can be passed
+        wherever an `rng` is expected. '''
+
+    def __init__(self, seed_sequence, block_size=65536):
+        # Uniforms and normals come from separate generators, so the k-th draw of either kind
+        # does not depend on how the two are interleaved or on the block size
+        uniform_seed, normal_seed = seed_sequence.spawn(2)
+        self.uniform_generator = np.random.default_rng(uniform_seed)
+        self.normal_generator = np.random.default_rng(normal_seed)
+        self.block_size = block_size
+
+        self.uniforms = np.empty(0)
+        self.uniform_cursor = 0
+        self.normals = np.empty(0)
+        self.normal_cursor = 0
+
+    def _take_uniforms(self, size):
+        if self.uniform_cursor + size <= len(self.uniforms):
+            draws = self.uniforms[self.uniform_cursor:self.uniform_cursor + size]
+            self.uniform_cursor += size
+            return draws
+        # Hand out what is left of this block, then move on to fresh blocks
+        remainder = self.uniforms[self.uniform_cursor:]
+        num_missing = size - len(remainder)
+        self.uniforms = self.uniform_generator.random(max(self.block_size, num_missing))
+        self.uniform_cursor = num_missing
+        return np.concatenate((remainder, self.uniforms[:num_missing]))
+
+    def _take_normals(self, size):
+        if self.normal_cursor + size <= len(self.normals):
+            draws = self.normals[self.normal_cursor:self.normal_cursor + size]
+            self.normal_cursor += size
+            return draws
+        remainder = self.normals[self.normal_cursor:]
+        num_missing = size - len(remainder)
+        self.normals = self.normal_generator.standard_normal(max(self.block_size, num_missing))
+        self.normal_cursor = num_missing
+        return np.concatenate((remainder, self.normals[:num_missing]))
+
+    def _draw(self, take, size):
+        if size is None:
+            return take(1)[0]
+        return take(int(np.prod(size))).reshape(size).copy()
+
+    def random(self, size=None):
+        return self._draw(self._take_uniforms, size)
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return low + (high - low) * self.random(size)
+
+    def standard_normal(self, size=None):
+        return self._draw(self._take_normals, size)
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        return loc + scale * self.standard_normal(size)
+
+    def integers(self, low, high=None, size=None):
+        if high is None:
+            low, high = 0, low
+        return (low + np.floor(self.random(size) * (high - low))).astype(np.int64)
+
+    def binomial(self, n, p, size=None):
+        assert np.all(np.asarray(n) == 1), 'Only Bernoulli draws are supported'
+        if size is None:
+            size = np.shape(p) or None
+        return (self.random(size) < p).astype(np.int64)
+
+    def choice(self, a, size=None, replace=True):
+        num_candidates = a if np.ndim(a) == 0 else len(a)
+        if replace:
+            idx = self.integers(0, num_candidates, size=size)
+        else:
+            # Ranks of uniform keys give a uniformly random sample without replacement
+            idx = np.argsort(self.random(num_candidates))[:size]
+        return idx if np.ndim(a) == 0 else np.asarray(a)[idx]
+
+
+class RandomStreams:
+    ''' Factory for reproducible, block-drawn random streams -- one per purpose.
+
+        The stream for `purpose` in run `run` is seeded with
+            SeedSequence(random_seed, spawn_key=(run, crc32(purpose)))
+        so the k-th draw of a purpose depends only on the seed, the run, the purpose name and k.
+        It does not depend on the block size or on how many draws other purposes made. '''
+
+    # Purposes used by the auction itself
+    SLOTS = 'auction/slots'
+    CONTEXTS = 'auction/contexts'
+    PARTICIPANTS = 'auction/participants'
+    CLICKS = 'auction/clicks'
+    CONVERSIONS = 'auction/conversions'
+
+    def __init__(self, random_seed, run=0, block_size=65536):
+        self.random_seed = random_seed
+        self.run = run
+        self.block_size = block_size
+        self.streams = {}
+
+    def stream(self, purpose):
+        if purpose not in self.streams:
+            seed_sequence = np.random.SeedSequence(self.random_seed, spawn_key=(self.run, zlib.crc32(purpose.encode())))
+            self.streams[purpose] = RandomStream(seed_sequence, block_size=self.block_size)
+        return self.streams[purpose]
+
+    def bidder_stream(self, agent_name):
+        return self.stream(f'bidder/{agent_name}')
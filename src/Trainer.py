@@ -0,0 +1,121 @@
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+@dataclass
+class TrainingStats:
+    ''' What happened during one `Trainer.fit` call '''
+    epochs: int
+    losses: np.ndarray
+    best_loss: float
+    best_epoch: int
+    seconds: float
+    # 'converged', 'max_epochs' or 'max_seconds'
+    stop_reason: str
+
+    @property
+    def final_loss(self):
+        return self.losses[-1] if len(self.losses) else np.nan
+
+
+class Trainer:
+    ''' First-order training loop shared by every torch model in the simulator.
+
+        Losses stay on the device and are only read back every `check_every` epochs. Scheduler steps and plateau
+        early stopping are then replayed over those epochs, so the per-epoch cost is just the optimisation step,
+        and a stop is detected at most `check_every` epochs late.
+        `max_epochs` and `max_seconds` cap every fit, on top of the epoch budget the caller asks for.
+        `compile` runs the loss function through `torch.compile`, which pays off for long fits on large logs.
+
+        With a `batch_size`, every epoch is a pass over the training data in shuffled minibatches of that size,
+        and the loss of an epoch is the mean over its minibatches.
+        With `warm_start`, every model keeps its optimizer -- and so its moment estimates -- from one fit to the next. '''
+
+    def __init__(self, check_every=64, max_epochs=None, max_seconds=None, compile=False, progress=True, batch_size=None, warm_start=False):
+        assert check_every >= 1
+        self.check_every = check_every
+        self.max_epochs = max_epochs
+        self.max_seconds = max_seconds
+        self.compile = compile
+        self.progress = progress
+        self.batch_size = batch_size
+        self.warm_start = warm_start
+        # Optimizers kept for warm starts, with the learning rates they started out with
+        self.optimizers = {}
+
+    def optimizer(self, key, make_optimizer):
+        ''' The optimizer to fit the model called `key` with: a new one from `make_optimizer()`,
+            or with `warm_start` the one from its previous fit, with its learning rates reset '''
+        if not self.warm_start:
+            return make_optimizer()
+        if key not in self.optimizers:
+            optimizer = make_optimizer()
+            self.optimizers[key] = (optimizer, [group['lr'] for group in optimizer.param_groups])
+        optimizer, initial_lrs = self.optimizers[key]
+        for group, lr in zip(optimizer.param_groups, initial_lrs):
+            group['lr'] = lr
+        return optimizer
+
+    def fit(self, loss_fn, optimizer, epochs, patience, num_samples, scheduler=None, min_delta=1e-6, min_epochs=0, name=''):
+        ''' Minimise `loss_fn(rows)` with `optimizer` for up to `epochs` epochs, over `num_samples` training samples.
+            `rows` indexes the training data: `slice(None)` for a full batch, or a tensor of row indices for a minibatch.
+            Stops once the loss has not improved on its best by more than `min_delta` for `patience` epochs,
+            but not before `min_epochs` epochs. `scheduler` is stepped with the loss after every epoch. '''
+        if self.max_epochs is not None:
+            epochs = min(epochs, self.max_epochs)
+        if self.compile:
+            loss_fn = torch.compile(loss_fn)
+        minibatch = self.batch_size is not None and num_samples > self.batch_size
+
+        start = time.perf_counter()
+        losses = []
+        best_epoch, best_loss = -1, np.inf
+        stop_reason = 'max_epochs'
+        progress_bar = tqdm(total=int(epochs), desc=f'{name}', disable=not self.progress)
+        epoch = 0
+        while epoch < epochs and stop_reason == 'max_epochs':
+            chunk = []
+            for _ in range(min(self.check_every, epochs - epoch)):
+                if minibatch:
+                    permutation = torch.randperm(num_samples)
+                    epoch_loss = 0.0
+                    for batch_start in range(0, num_samples, self.batch_size):
+                        rows = permutation[batch_start:batch_start + self.batch_size]
+                        epoch_loss = epoch_loss + self.step(loss_fn, optimizer, rows) * len(rows)
+                    chunk.append(epoch_loss / num_samples)
+                else:
+                    chunk.append(self.step(loss_fn, optimizer, slice(None)))
+
+            # One read-back for the whole chunk
+            for loss in torch.stack(chunk).tolist():
+                losses.append(loss)
+                if scheduler is not None:
+                    scheduler.step(loss)
+                if (best_loss - loss) > min_delta:
+                    best_epoch, best_loss = epoch, loss
+                elif epoch - best_epoch > patience and epoch >= min_epochs:
+                    stop_reason = 'converged'
+                epoch += 1
+            progress_bar.update(len(chunk))
+
+            if stop_reason == 'max_epochs' and self.max_seconds is not None and time.perf_counter() - start > self.max_seconds:
+                stop_reason = 'max_seconds'
+        progress_bar.close()
+
+        if stop_reason != 'max_epochs':
+            print(f'Stopping at Epoch {epoch} ({stop_reason})')
+
+        return TrainingStats(epochs=epoch, losses=np.array(losses), best_loss=best_loss, best_epoch=best_epoch,
+                             seconds=time.perf_counter() - start, stop_reason=stop_reason)
+
+    @staticmethod
+    def step(loss_fn, optimizer, rows):
+        optimizer.zero_grad()  # Setting our stored gradients equal to zero
+        loss = loss_fn(rows)
+        loss.backward()  # Computes the gradient of the given tensor w.r.t. the weights/bias
+        optimizer.step()  # Updates weights and biases with the optimizer
+        return loss.detach()
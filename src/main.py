@@ -1,11 +1,15 @@
 import argparse
 import json
+import multiprocessing
 import matplotlib.pyplot as plt
 import numpy as np
 import os
+import pickle
 import pandas as pd
 import seaborn as sns
+import torch
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 from tqdm import tqdm
 
@@ -14,6 +18,19 @@ from AuctionAllocation import * # FirstPrice, SecondPrice
 from Auction import Auction
 from Bidder import *  # EmpiricalShadedBidder, TruthfulBidder
 from BidderAllocation import *  #  LogisticTSAllocator, OracleAllocator
+from Plotting import DiagnosticPlotter
+from RandomStreams import RandomStreams
+from Trainer import Trainer
+
+# Plotting config
+FIGSIZE = (8, 5)
+FONTSIZE = 14
+
+# Metrics computed by `Agent.metrics()` that are recorded every iteration
+AGENT_METRICS = ['allocation_regret', 'estimation_regret', 'overbid_regret', 'underbid_regret', 'best_expected_value',
+                 'CTR_RMSE', 'CTR_bias', 'total_clicks', 'total_conversions', 'total_sales_revenue', 'total_spend', 'CVR', 'ACoS']
+# Every measure recorded per agent and iteration
+AGENT_MEASURES = ['net_utility', 'gross_utility'] + AGENT_METRICS + ['gamma']
 
 
 def parse_kwargs(kwargs):
@@ -77,19 +94,26 @@ def parse_config(path):
     return rng, config, agent_configs, agents2items, agents2item_values, num_runs, max_slots, embedding_size, embedding_var, obs_embedding_size, fixed_cvr, fixed_sales_revenue_per_conversion
 
 
-def instantiate_agents(rng, agent_configs, agents2item_values, agents2items):
+def instantiate_agents(rng, agent_configs, agents2item_values, agents2items, streams=None, training=None):
     # Store agents to be re-instantiated in subsequent runs
-    # Set up agents
-    agents = [
-        Agent(rng=rng,
-              name=agent_config['name'],
-              num_items=agent_config['num_items'],
-              item_values=agents2item_values[agent_config['name']],
-              allocator=eval(f"{agent_config['allocator']['type']}(rng=rng{parse_kwargs(agent_config['allocator']['kwargs'])})"),
-              bidder=eval(f"{agent_config['bidder']['type']}(rng=rng{parse_kwargs(agent_config['bidder']['kwargs'])})"),
-              memory=(0 if 'memory' not in agent_config.keys() else agent_config['memory']))
-        for agent_config in agent_configs
-    ]
+    # Set up agents -- bidders draw their shading factors from their own stream if streams are enabled
+    # Training loop settings apply to every agent, unless the agent's own config overrides them
+    agents = []
+    for agent_config in agent_configs:
+        bidder_rng = streams.bidder_stream(agent_config['name']) if streams else rng
+        agents.append(
+            Agent(rng=rng,
+                  name=agent_config['name'],
+                  num_items=agent_config['num_items'],
+                  item_values=agents2item_values[agent_config['name']],
+                  allocator=eval(f"{agent_config['allocator']['type']}(rng=rng{parse_kwargs(agent_config['allocator']['kwargs'])})"),
+                  bidder=eval(f"{agent_config['bidder']['type']}(rng=bidder_rng{parse_kwargs(agent_config['bidder']['kwargs'])})"),
+                  memory=(0 if 'memory' not in agent_config.keys() else agent_config['memory']),
+                  participation_rate=agent_config.get('participation_rate', 1.0))
+        )
+        agent_training = {**(training or {}), **agent_config.get('training', {})}
+        agents[-1].allocator.trainer = Trainer(**agent_training)
+        agents[-1].bidder.trainer = Trainer(**agent_training)
 
     for agent in agents:
         if isinstance(agent.allocator, OracleAllocator):
@@ -99,7 +123,7 @@ def instantiate_agents(rng, agent_configs, agents2item_values, agents2items):
 
 
 def instantiate_auction(rng, config, agents2items, agents2item_values, agents, max_slots, 
-                        embedding_size, embedding_var, obs_embedding_size, fixed_cvr, fixed_sales_revenue_per_conversion):
+                        embedding_size, embedding_var, obs_embedding_size, fixed_cvr, fixed_sales_revenue_per_conversion, streams=None):
     return (Auction(rng,
                     eval(f"{config['allocation']}()"),
                     agents,
@@ -111,16 +135,163 @@ def instantiate_auction(rng, config, agents2items, agents2item_values, agents, m
                     obs_embedding_size,
                     config['num_participants_per_round'],
                     fixed_cvr,
-                    fixed_sales_revenue_per_conversion),
+                    fixed_sales_revenue_per_conversion,
+                    streams),
             config['num_iter'], config['rounds_per_iter'], config['output_dir'])
 
 
-def simulation_run():
-    for i in range(num_iter):
+def seed_global_generators(seed_sequence):
+    ''' Seed the global NumPy and PyTorch generators, which libraries draw from (model initialisation, Thompson sampling) '''
+    global_state = seed_sequence.generate_state(2)
+    np.random.seed(global_state[0])
+    torch.manual_seed(int(global_state[1]))
+
+
+def seed_run(random_seed, run):
+    ''' Seed everything a run draws from with a stream spawned from `random_seed`.
+        The generator only depends on the seed and the run index, so runs give the same results
+        whether they execute in one process or spread over several. '''
+    run_seed, global_seed = np.random.SeedSequence(random_seed, spawn_key=(run,)).spawn(2)
+    seed_global_generators(global_seed)
+    return np.random.default_rng(run_seed)
+
+
+def set_torch_threads(num_threads):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def update_agent(agent, iteration, seed_sequence, plot=False):
+    ''' Update an agent's models with the global generators seeded for this agent and iteration.
+        The generators are restored afterwards, so updates leave no trace on the auction's draws
+        and give the same results in this process or in a worker. Returns the trained allocator and bidder.
+        With `plot`, the bidder records diagnostics of the update for `Plotting` to render. '''
+    with torch.random.fork_rng(devices=[]):
+        numpy_state = np.random.get_state()
+        seed_global_generators(seed_sequence)
+        agent.update(iteration=iteration, plot=plot, figsize=FIGSIZE, fontsize=FONTSIZE)
+        np.random.set_state(numpy_state)
+    return agent.allocator, agent.bidder
+
+
+def update_agents(agents, iteration, seed_sequences, executor=None, plot=False):
+    ''' Update every agent's models, in a pool of worker processes if an executor is given '''
+    if executor is None:
+        for agent, seed_sequence in zip(agents, seed_sequences):
+            update_agent(agent, iteration, seed_sequence, plot)
+        return
+
+    # Generators stay in this process -- they are shared between the agents and the auction,
+    # and updates do not draw from them
+    rngs = [(agent.rng, agent.allocator.rng, agent.bidder.rng) for agent in agents]
+    try:
+        for agent in agents:
+            agent.rng = agent.allocator.rng = agent.bidder.rng = None
+        # Agents are pickled lazily by the pool, so wait for every result before restoring the generators
+        futures = [executor.submit(update_agent, agent, iteration, seed_sequence, plot) for agent, seed_sequence in zip(agents, seed_sequences)]
+        trained = [future.result() for future in futures]
+    finally:
+        for agent, (rng, allocator_rng, bidder_rng) in zip(agents, rngs):
+            agent.rng, agent.allocator.rng, agent.bidder.rng = rng, allocator_rng, bidder_rng
+
+    # Bring the trained models back
+    for agent, (allocator, bidder), (_, allocator_rng, bidder_rng) in zip(agents, trained, rngs):
+        allocator.rng, bidder.rng = allocator_rng, bidder_rng
+        agent.allocator, agent.bidder = allocator, bidder
+
+
+def checkpoint_path(output_dir, run):
+    return os.path.join(output_dir, 'checkpoints', f'run_{run}.pkl')
+
+
+def save_checkpoint(path, state):
+    ''' Pickle a checkpoint, replacing the previous one atomically so a crash while saving leaves it intact '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path, config):
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    # A run can be extended with more iterations, but not continued under different settings
+    ignored_keys = ('num_iter', 'checkpoint_every')
+    if {k: v for k, v in state['config'].items() if k not in ignored_keys} != {k: v for k, v in config.items() if k not in ignored_keys}:
+        raise ValueError(f'Checkpoint {path} was written for a different config')
+    return state
+
+
+def simulation_run(config_path, run, update_workers=1, torch_threads=None, resume=False):
+    ''' Simulate a single run, returns its measures as {measure: {agent: [value per iteration]}}
+        and the auction revenue per iteration.
+        Agents' models are trained in a pool of `update_workers` processes, using `torch_threads` threads each.
+        With `resume`, the run continues from its last checkpoint if there is one. '''
+    _, config, agent_configs, agents2items, agents2item_values, _, max_slots, \
+    embedding_size, embedding_var, obs_embedding_size, fixed_cvr, fixed_sales_revenue_per_conversion = parse_config(config_path)
+    num_iter, rounds_per_iter = config['num_iter'], config['rounds_per_iter']
+
+    # Number of auction rounds to simulate per vectorised batch (0 simulates one round at a time)
+    rounds_per_batch = config.get('rounds_per_batch', 0)
+
+    # Block size for per-purpose random streams (0 draws everything from the run's generator)
+    random_stream_block_size = config.get('random_stream_block_size', 0)
+
+    # Save the full simulation state every this many iterations (0 never checkpoints)
+    checkpoint_every = config.get('checkpoint_every', 0)
+    checkpoint = checkpoint_path(config['output_dir'], run)
+
+    # Render the diagnostics of every model update to <output_dir>/diagnostics/run_<run>/
+    plotter = None
+    if config.get('plot_diagnostics', False):
+        plotter = DiagnosticPlotter(figsize=FIGSIZE, fontsize=FONTSIZE)
+        diagnostics_dir = os.path.join(config['output_dir'], 'diagnostics', f'run_{run}')
+        os.makedirs(diagnostics_dir, exist_ok=True)
+
+    if resume and os.path.exists(checkpoint):
+        # Agents, their logs and models, and the run's generators all live in the pickled auction
+        state = load_checkpoint(checkpoint, config)
+        auction = state['auction']
+        agent2measure = state['agent2measure']
+        auction_revenue = state['auction_revenue']
+        np.random.set_state(state['numpy_state'])
+        torch.set_rng_state(state['torch_state'])
+        first_iter = state['iteration'] + 1
+        print(f'Resuming run {run} from iteration {first_iter}')
+    else:
+        # Reinstantiate agents and auction per run
+        rng = seed_run(config['random_seed'], run)
+        streams = RandomStreams(config['random_seed'], run=run, block_size=random_stream_block_size) if random_stream_block_size else None
+        agents = instantiate_agents(rng, agent_configs, agents2item_values, agents2items, streams, config.get('training'))
+        auction, _, _, _ = instantiate_auction(
+            rng, config, agents2items, agents2item_values, agents,
+            max_slots, embedding_size, embedding_var, obs_embedding_size,
+            fixed_cvr, fixed_sales_revenue_per_conversion, streams
+        )
+
+        # Placeholders for summary statistics per run
+        agent2measure = {measure: defaultdict(list) for measure in AGENT_MEASURES}
+        auction_revenue = []
+        first_iter = 0
+
+    if first_iter >= num_iter:
+        return agent2measure, auction_revenue
+
+    # Agent updates are independent of each other, so they can be trained side by side
+    executor = None
+    if update_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=update_workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=set_torch_threads, initargs=(torch_threads,))
+
+    for i in range(first_iter, num_iter):
         print(f'==== ITERATION {i} ====')
 
-        for _ in tqdm(range(rounds_per_iter)):
-            auction.simulate_opportunity()
+        if rounds_per_batch:
+            for start in tqdm(range(0, rounds_per_iter, rounds_per_batch)):
+                auction.simulate_batch(min(rounds_per_batch, rounds_per_iter - start))
+        else:
+            for _ in tqdm(range(rounds_per_iter)):
+                auction.simulate_opportunity()
 
         names = [agent.name for agent in auction.agents]
         net_utilities = [agent.net_utility for agent in auction.agents]
@@ -131,139 +302,109 @@ def simulation_run():
         print(result)
         print(f'\tAuction revenue: \t {auction.revenue}')
 
-        for agent_id, agent in enumerate(auction.agents):
-            agent.update(iteration=i, plot=True, figsize=FIGSIZE, fontsize=FONTSIZE)
+        # Every agent update draws from its own seed, so results do not depend on how updates are spread over workers
+        update_seeds = [np.random.SeedSequence(config['random_seed'], spawn_key=(run, i, agent_id)) for agent_id in range(len(auction.agents))]
+        update_agents(auction.agents, i, update_seeds, executor, plot=plotter is not None)
 
-            agent2net_utility[agent.name].append(agent.net_utility)
-            agent2gross_utility[agent.name].append(agent.gross_utility)
-
-            agent2allocation_regret[agent.name].append(agent.get_allocation_regret())
-            agent2estimation_regret[agent.name].append(agent.get_estimation_regret())
-            agent2overbid_regret[agent.name].append(agent.get_overbid_regret())
-            agent2underbid_regret[agent.name].append(agent.get_underbid_regret())
-
-            agent2CTR_RMSE[agent.name].append(agent.get_CTR_RMSE())
-            agent2CTR_bias[agent.name].append(agent.get_CTR_bias())
-
-            # Collect new CVR and ACoS related metrics
-            agent2total_clicks[agent.name].append(agent.get_total_clicks())
-            agent2total_conversions[agent.name].append(agent.get_total_conversions())
-            agent2total_sales_revenue[agent.name].append(agent.get_total_sales_revenue())
-            agent2total_spend[agent.name].append(agent.get_total_spend())
-            agent2CVR[agent.name].append(agent.get_CVR())
-            agent2ACoS[agent.name].append(agent.get_ACoS())
+        for agent_id, agent in enumerate(auction.agents):
+            agent2measure['net_utility'][agent.name].append(agent.net_utility)
+            agent2measure['gross_utility'][agent.name].append(agent.gross_utility)
 
-            if isinstance(agent.bidder, PolicyLearningBidder) or isinstance(agent.bidder, DoublyRobustBidder):
-                agent2gamma[agent.name].append(torch.mean(torch.Tensor(agent.bidder.gammas)).detach().item())
-            elif not agent.bidder.truthful:
-                agent2gamma[agent.name].append(np.mean(agent.bidder.gammas))
+            # All metrics over the agent's logs in one pass
+            metrics = agent.metrics()
+            for measure in AGENT_METRICS:
+                agent2measure[measure][agent.name].append(metrics[measure])
 
-            best_expected_value = np.mean([opp.best_expected_value for opp in agent.logs])
-            agent2best_expected_value[agent.name].append(best_expected_value)
+            if not agent.bidder.truthful:
+                agent2measure['gamma'][agent.name].append(np.mean(agent.bidder.gammas))
 
-            print('Average Best Value for Agent: ', best_expected_value)
+            print('Average Best Value for Agent: ', metrics['best_expected_value'])
+            if plotter is not None:
+                plotter.render_all(agent.bidder.diagnostics, os.path.join(diagnostics_dir, f"{agent.name.replace(' ', '_')}_iter_{i}"))
+            agent.bidder.diagnostics.clear()
             agent.clear_utility()
             agent.clear_logs()
 
         auction_revenue.append(auction.revenue)
         auction.clear_revenue()
 
+        if checkpoint_every and ((i + 1) % checkpoint_every == 0 or i == num_iter - 1):
+            save_checkpoint(checkpoint, {'config': config,
+                                         'iteration': i,
+                                         'auction': auction,
+                                         'agent2measure': agent2measure,
+                                         'auction_revenue': auction_revenue,
+                                         'numpy_state': np.random.get_state(),
+                                         'torch_state': torch.get_rng_state()})
+
+    if executor is not None:
+        executor.shutdown()
+
+    return agent2measure, auction_revenue
+
+
+def simulate_runs(config_path, num_runs, workers=1, update_workers=1, resume=False):
+    ''' Simulate all runs, in a pool of `workers` processes if there is more than one.
+        Returns {measure: {run: {agent: [value per iteration]}}} and {run: [auction revenue per iteration]} '''
+    # Split the cores between all processes that train models at the same time
+    torch_threads = max(1, (os.cpu_count() or 1) // (workers * update_workers)) if workers * update_workers > 1 else None
+    if workers > 1:
+        # Fresh interpreters rather than forks, so no PyTorch thread pools are inherited half-initialised
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=set_torch_threads, initargs=(torch_threads,)) as executor:
+            results = list(executor.map(simulation_run, [config_path] * num_runs, range(num_runs),
+                                        [update_workers] * num_runs, [torch_threads] * num_runs, [resume] * num_runs))
+    else:
+        results = [simulation_run(config_path, run, update_workers, torch_threads, resume) for run in range(num_runs)]
+
+    # Merge the per-run measures in run order
+    run2agent2measure = {measure: {} for measure in AGENT_MEASURES}
+    run2auction_revenue = {}
+    for run, (agent2measure, auction_revenue) in enumerate(results):
+        for measure, agent2values in agent2measure.items():
+            run2agent2measure[measure][run] = agent2values
+        run2auction_revenue[run] = auction_revenue
+    return run2agent2measure, run2auction_revenue
+
+
 if __name__ == '__main__':
     # Parse commandline arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('config', type=str, help='Path to experiment configuration file')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to spread the runs over')
+    parser.add_argument('--update-workers', type=int, default=1, help='Number of processes per run to train agent models in')
+    parser.add_argument('--resume', action='store_true', help='Continue every run from its last checkpoint')
     args = parser.parse_args()
 
     # Parse configuration file
     rng, config, agent_configs, agents2items, agents2item_values, num_runs, max_slots, \
     embedding_size, embedding_var, obs_embedding_size, fixed_cvr, fixed_sales_revenue_per_conversion = parse_config(args.config)
-
-    # Plotting config
-    FIGSIZE = (8, 5)
-    FONTSIZE = 14
-
-    # Placeholders for summary statistics over all runs
-    run2agent2net_utility = {}
-    run2agent2gross_utility = {}
-    run2agent2allocation_regret = {}
-    run2agent2estimation_regret = {}
-    run2agent2overbid_regret = {}
-    run2agent2underbid_regret = {}
-    run2agent2best_expected_value = {}
-
-    run2agent2CTR_RMSE = {}
-    run2agent2CTR_bias = {}
-    run2agent2gamma = {}
-
-    # New metrics placeholders over all runs
-    run2agent2total_clicks = {}
-    run2agent2total_conversions = {}
-    run2agent2total_sales_revenue = {}
-    run2agent2total_spend = {}
-    run2agent2CVR = {}
-    run2agent2ACoS = {}
-
-    run2auction_revenue = {}
+    num_iter, rounds_per_iter, output_dir = config['num_iter'], config['rounds_per_iter'], config['output_dir']
 
     # Repeated runs
-    for run in range(num_runs):
-        # Reinstantiate agents and auction per run
-        agents = instantiate_agents(rng, agent_configs, agents2item_values, agents2items)
-        auction, num_iter, rounds_per_iter, output_dir = instantiate_auction(
-            rng, config, agents2items, agents2item_values, agents, 
-            max_slots, embedding_size, embedding_var, obs_embedding_size,
-            fixed_cvr, fixed_sales_revenue_per_conversion
-        )
-
-
-        # Placeholders for summary statistics per run
-        agent2net_utility = defaultdict(list)
-        agent2gross_utility = defaultdict(list)
-        agent2allocation_regret = defaultdict(list)
-        agent2estimation_regret = defaultdict(list)
-        agent2overbid_regret = defaultdict(list)
-        agent2underbid_regret = defaultdict(list)
-        agent2best_expected_value = defaultdict(list)
-
-        agent2CTR_RMSE = defaultdict(list)
-        agent2CTR_bias = defaultdict(list)
-        agent2gamma = defaultdict(list)
-        
-        # New metrics placeholders per run
-        agent2total_clicks = defaultdict(list)
-        agent2total_conversions = defaultdict(list)
-        agent2total_sales_revenue = defaultdict(list)
-        agent2total_spend = defaultdict(list)
-        agent2CVR = defaultdict(list)
-        agent2ACoS = defaultdict(list)
-
-        auction_revenue = []
-
-        # Run simulation (with global parameters -- fine for the purposes of this script)
-        simulation_run()
-
-        # Store
-        run2agent2net_utility[run] = agent2net_utility
-        run2agent2gross_utility[run] = agent2gross_utility
-        run2agent2allocation_regret[run] = agent2allocation_regret
-        run2agent2estimation_regret[run] = agent2estimation_regret
-        run2agent2overbid_regret[run] = agent2overbid_regret
-        run2agent2underbid_regret[run] = agent2underbid_regret
-        run2agent2best_expected_value[run] = agent2best_expected_value
-
-        run2agent2CTR_RMSE[run] = agent2CTR_RMSE
-        run2agent2CTR_bias[run] = agent2CTR_bias
-        run2agent2gamma[run] = agent2gamma
-
-        # Store new metrics
-        run2agent2total_clicks[run] = agent2total_clicks
-        run2agent2total_conversions[run] = agent2total_conversions
-        run2agent2total_sales_revenue[run] = agent2total_sales_revenue
-        run2agent2total_spend[run] = agent2total_spend
-        run2agent2CVR[run] = agent2CVR
-        run2agent2ACoS[run] = agent2ACoS
-
-        run2auction_revenue[run] = auction_revenue
+    run2agent2measure, run2auction_revenue = simulate_runs(args.config, num_runs, workers=min(args.workers, num_runs),
+                                                     update_workers=args.update_workers, resume=args.resume)
+
+    # Summary statistics over all runs
+    run2agent2net_utility = run2agent2measure['net_utility']
+    run2agent2gross_utility = run2agent2measure['gross_utility']
+    run2agent2allocation_regret = run2agent2measure['allocation_regret']
+    run2agent2estimation_regret = run2agent2measure['estimation_regret']
+    run2agent2overbid_regret = run2agent2measure['overbid_regret']
+    run2agent2underbid_regret = run2agent2measure['underbid_regret']
+    run2agent2best_expected_value = run2agent2measure['best_expected_value']
+
+    run2agent2CTR_RMSE = run2agent2measure['CTR_RMSE']
+    run2agent2CTR_bias = run2agent2measure['CTR_bias']
+    run2agent2gamma = run2agent2measure['gamma']
+
+    # New metrics over all runs
+    run2agent2total_clicks = run2agent2measure['total_clicks']
+    run2agent2total_conversions = run2agent2measure['total_conversions']
+    run2agent2total_sales_revenue = run2agent2measure['total_sales_revenue']
+    run2agent2total_spend = run2agent2measure['total_spend']
+    run2agent2CVR = run2agent2measure['CVR']
+    run2agent2ACoS = run2agent2measure['ACoS']
 
     # Make sure we can write results
     if not os.path.exists(output_dir):
@@ -318,6 +459,7 @@ if __name__ == '__main__':
         plt.tight_layout()
         plt.savefig(f"{output_dir}/{measure_name.replace(' ', '_')}_{rounds_per_iter}_rounds_{num_iter}_iters_{num_runs}_runs_{obs_embedding_size}_emb_of_{embedding_size}.pdf", bbox_inches='tight')
         # plt.show()
+        plt.close(fig)
         return df
 
     net_utility_df = plot_measure_per_agent(run2agent2net_utility, 'Net Utility').sort_values(['Agent', 'Run', 'Iteration'])
@@ -399,6 +541,7 @@ if __name__ == '__main__':
         plt.tight_layout()
         plt.savefig(f"{output_dir}/{measure_name.replace(' ', '_')}_{rounds_per_iter}_rounds_{num_iter}_iters_{num_runs}_runs_{obs_embedding_size}_emb_of_{embedding_size}.pdf", bbox_inches='tight')
         # plt.show()
+        plt.close(fig)
         return df
 
     auction_revenue_df = plot_measure_overall(run2auction_revenue, 'Auction Revenue')
@@ -0,0 +1,173 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+# Rough cost of one agent update, in simulated bids -- an update trains for up to 16k epochs
+UPDATE_COST = 1_000_000
+
+
+def set_path(config, path, value):
+    ''' Set a value in a nested config by dotted path, e.g. "agents.0.bidder.kwargs.loss" '''
+    *parents, leaf = path.split('.')
+    node = config
+    for key in parents:
+        node = node[int(key)] if isinstance(node, list) else node[key]
+    if isinstance(node, list):
+        node[int(leaf)] = value
+    else:
+        node[leaf] = value
+
+
+def axis_settings(axis, values):
+    ''' {label: {dotted path: value}} for an axis.
+        An axis is either a list of values for the dotted path it is named after,
+        or a mapping from labels to the overrides they stand for. '''
+    if isinstance(values, list):
+        return {str(value): {axis: value} for value in values}
+    return values
+
+
+def estimate_cost(config):
+    ''' Relative cost of a job: simulated bids plus an allowance per agent update '''
+    num_agents = sum(agent_config.get('num_copies', 1) for agent_config in config['agents'])
+    bids_per_iter = config['rounds_per_iter'] * config['num_participants_per_round']
+    return config.get('num_runs', 1) * config['num_iter'] * (bids_per_iter + UPDATE_COST * num_agents)
+
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def expand_jobs(sweep):
+    ''' Expand a sweep into a list of (job name, config), longest jobs first '''
+    if isinstance(sweep['base_config'], str):
+        with open(sweep['base_config']) as f:
+            base_config = json.load(f)
+    else:
+        base_config = sweep['base_config']
+
+    axes = {axis: axis_settings(axis, values) for axis, values in sweep['axes'].items()}
+    default_name = '_'.join(f'{axis.split(".")[-1]}{{{axis}}}' for axis in axes)
+    name_template = sweep.get('name', default_name)
+    output_root = sweep.get('output_root', 'results')
+
+    jobs = []
+    for labels in itertools.product(*axes.values()):
+        axis2label = dict(zip(axes, labels))
+        config = deepcopy(base_config)
+        for axis, label in axis2label.items():
+            for path, value in axes[axis][label].items():
+                set_path(config, path, value)
+        name = name_template
+        for axis, label in axis2label.items():
+            name = name.replace(f'{{{axis}}}', label)
+        config['output_dir'] = os.path.join(output_root, name) + '/'
+        jobs.append((name, config))
+
+    # Longest jobs first, so the pool does not end on a single straggler
+    jobs.sort(key=lambda job: estimate_cost(job[1]), reverse=True)
+    return jobs
+
+
+class Journal:
+    ''' Append-only record of completed jobs, so a killed sweep resumes where it stopped.
+        A job counts as done if it finished successfully with exactly the same config. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = f.read().split('\n')
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # An empty line, or a line cut short when the sweep was killed
+                    continue
+                if entry['returncode'] == 0:
+                    self.completed.add((entry['job'], entry['config_hash']))
+            if lines[-1]:
+                # Start new entries on a fresh line
+                with open(path, 'a') as f:
+                    f.write('\n')
+
+    def is_done(self, name, config):
+        return (name, config_hash(config)) in self.completed
+
+    def record(self, name, config, returncode, seconds):
+        entry = {'job': name, 'config_hash': config_hash(config), 'returncode': returncode, 'seconds': round(seconds, 1)}
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if returncode == 0:
+                self.completed.add((name, entry['config_hash']))
+
+
+def run_job(name, config, journal, workers=1):
+    ''' Run `src/main.py` on a job's config, logging its output next to its results '''
+    output_dir = config['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+    config_path = os.path.join(output_dir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=4)
+
+    env = dict(os.environ)
+    env.setdefault('MPLBACKEND', 'Agg')
+    start = time.time()
+    with open(os.path.join(output_dir, 'main.log'), 'w') as log:
+        returncode = subprocess.call([sys.executable, MAIN, config_path, '--workers', str(workers)],
+                                     stdout=log, stderr=subprocess.STDOUT, env=env)
+    seconds = time.time() - start
+    journal.record(name, config, returncode, seconds)
+    print(f'{name}: {"done" if returncode == 0 else f"failed ({returncode})"} in {seconds:.0f}s')
+    return returncode
+
+
+def run_sweep(sweep, jobs=1, workers=1, dry_run=False):
+    ''' Run every job of a sweep that is not done yet on a pool of `jobs` concurrent simulations.
+        Returns the number of failed jobs. '''
+    all_jobs = expand_jobs(sweep)
+    output_root = sweep.get('output_root', 'results')
+    os.makedirs(output_root, exist_ok=True)
+    journal = Journal(os.path.join(output_root, 'sweep_journal.jsonl'))
+
+    pending = [(name, config) for name, config in all_jobs if not journal.is_done(name, config)]
+    print(f'{len(all_jobs)} jobs, {len(all_jobs) - len(pending)} already done')
+    if dry_run:
+        for name, config in pending:
+            print(f'\t{name}\t(cost {estimate_cost(config):.3g})')
+        return 0
+
+    # Every job is a subprocess, so threads are enough to keep `jobs` of them busy
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_job, name, config, journal, workers) for name, config in pending]
+        return sum(future.result() != 0 for future in futures)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Expand a base config over parameter axes and run every resulting job')
+    parser.add_argument('sweep', type=str, help='Path to sweep specification')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of simulations to run at the same time')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes per simulation to spread its runs over')
+    parser.add_argument('--dry-run', action='store_true', help='List the pending jobs without running them')
+    args = parser.parse_args()
+
+    with open(args.sweep) as f:
+        sweep = json.load(f)
+
+    num_failed = run_sweep(sweep, jobs=args.jobs, workers=args.workers, dry_run=args.dry_run)
+    sys.exit(1 if num_failed else 0)
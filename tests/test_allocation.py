@@ -0,0 +1,52 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from AuctionAllocation import AllocationMechanism, FirstPrice, SecondPrice
+
+
+class TestAllocateBatch(unittest.TestCase):
+    def check_against_scalar(self, mechanism, num_participants, max_slots):
+        rng = np.random.default_rng(num_participants * 10 + max_slots)
+        bids = rng.random((200, num_participants))
+        num_slots = rng.integers(1, max_slots + 1, size=200)
+
+        winners, prices, second_prices = mechanism.allocate_batch(bids, num_slots)
+        expected = AllocationMechanism.allocate_batch(mechanism, bids, num_slots)
+
+        np.testing.assert_array_equal(winners, expected[0])
+        np.testing.assert_allclose(prices, expected[1])
+        np.testing.assert_allclose(second_prices, expected[2])
+
+    def test_first_price_matches_scalar_allocation(self):
+        for num_participants, max_slots in [(2, 1), (6, 1), (6, 3), (3, 3)]:
+            self.check_against_scalar(FirstPrice(), num_participants, max_slots)
+
+    def test_second_price_matches_scalar_allocation(self):
+        for num_participants, max_slots in [(2, 1), (6, 1), (6, 3), (4, 2)]:
+            self.check_against_scalar(SecondPrice(), num_participants, max_slots)
+
+    def test_unused_slots(self):
+        bids = np.array([[0.1, 0.5, 0.3], [0.9, 0.2, 0.4]])
+        winners, prices, _ = SecondPrice().allocate_batch(bids, np.array([1, 2]))
+        np.testing.assert_array_equal(winners, [[1, -1], [0, 2]])
+        np.testing.assert_allclose(prices, [[0.3, 0.0], [0.4, 0.2]])
+
+    def test_competing_bids(self):
+        rng = np.random.default_rng(0)
+        for num_participants, max_slots in [(2, 1), (6, 1), (6, 3), (3, 3)]:
+            bids = rng.random((100, num_participants))
+            num_slots = rng.integers(1, max_slots + 1, size=100)
+            competing_bids = FirstPrice.competing_bids(bids, num_slots)
+            for row, k in enumerate(num_slots):
+                for i in range(num_participants):
+                    others = -np.sort(-np.delete(bids[row], i))
+                    self.assertEqual(competing_bids[row, i], others[k - 1] if k <= len(others) else 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
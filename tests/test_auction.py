@@ -0,0 +1,82 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from Agent import Agent
+from Auction import Auction
+from AuctionAllocation import SecondPrice
+from Bidder import TruthfulBidder
+from BidderAllocation import OracleAllocator
+
+
+def make_auction(seed=0, num_agents=5, num_participants=3, embedding_size=4):
+    rng = np.random.default_rng(seed)
+    agents2items = {f'Agent {i}': np.hstack((rng.normal(0.0, 1.0, size=(2, embedding_size)), -3.0 * np.ones((2, 1))))
+                    for i in range(num_agents)}
+    agents2item_values = {name: rng.lognormal(0.1, 0.2, 2) for name in agents2items}
+    agents = []
+    for name in agents2items:
+        agent = Agent(rng=rng, name=name, num_items=2, item_values=agents2item_values[name],
+                      allocator=OracleAllocator(rng=rng), bidder=TruthfulBidder(rng=rng))
+        agent.allocator.update_item_embeddings(agents2items[name])
+        agents.append(agent)
+    auction = Auction(rng, SecondPrice(), agents, agents2items, agents2item_values, 1, embedding_size, 1.0,
+                      embedding_size, num_participants, 0.5, 10.0)
+    return auction
+
+
+class TestSimulateBatch(unittest.TestCase):
+    def test_logs_and_revenue_are_consistent(self):
+        auction = make_auction()
+        num_rounds = 500
+        auction.simulate_batch(num_rounds)
+
+        self.assertEqual(sum(len(agent.logs) for agent in auction.agents), num_rounds * 3)
+        wins = sum(sum(opp.won for opp in agent.logs) for agent in auction.agents)
+        self.assertEqual(wins, num_rounds)
+        spend = sum(agent.get_total_spend() for agent in auction.agents)
+        self.assertAlmostEqual(spend, auction.revenue, places=4)
+
+        for agent in auction.agents:
+            for opp in agent.logs:
+                self.assertTrue(opp.won or (opp.price == 0.0 and not opp.outcome))
+                self.assertTrue(opp.outcome or not opp.conversion)
+                # A single slot is won by outbidding the highest competing bid, which is the second price
+                self.assertEqual(opp.won, opp.bid > opp.competing_bid)
+                if opp.won:
+                    self.assertAlmostEqual(opp.price, opp.competing_bid, places=5)
+                # Truthful oracle bidders bid their true expected value
+                self.assertAlmostEqual(opp.bid, opp.true_CTR * opp.value, places=5)
+
+    def test_utilities_match_logs(self):
+        auction = make_auction(seed=1)
+        auction.simulate_batch(300)
+        for agent in auction.agents:
+            gross = sum(opp.value * opp.outcome for opp in agent.logs if opp.won)
+            self.assertAlmostEqual(agent.gross_utility, gross, places=4)
+            self.assertAlmostEqual(agent.net_utility, gross - agent.get_total_spend(), places=4)
+
+    def test_metrics_match_per_impression_sums(self):
+        auction = make_auction(seed=2)
+        auction.simulate_batch(400)
+        for agent in auction.agents:
+            metrics = agent.metrics()
+            logs = list(agent.logs)
+            won = [opp for opp in logs if opp.won]
+            clicks = sum(opp.outcome for opp in won)
+            conversions = sum(opp.conversion for opp in won)
+            self.assertAlmostEqual(metrics['allocation_regret'], sum(opp.best_expected_value - opp.true_CTR * opp.value for opp in logs), places=3)
+            self.assertAlmostEqual(metrics['overbid_regret'], sum(opp.price - opp.second_price for opp in won), places=3)
+            self.assertAlmostEqual(metrics['total_spend'], sum(opp.price for opp in won), places=3)
+            self.assertEqual(metrics['total_clicks'], clicks)
+            self.assertEqual(metrics['total_conversions'], conversions)
+            self.assertAlmostEqual(metrics['CVR'], conversions / clicks if clicks else 0.0)
+            self.assertEqual(agent.get_ACoS(), metrics['ACoS'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from Bidder import DoublyRobustBidder, EmpiricalShadedBidder, PolicyLearningBidder, TruthfulBidder, ValueLearningBidder
+
+
+def make_bidders(seed, initialised):
+    ''' Every bidder class, with their models marked as trained if `initialised` '''
+    rng = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+    bidders = [TruthfulBidder(rng),
+               EmpiricalShadedBidder(rng, gamma_sigma=0.1, init_gamma=0.8),
+               ValueLearningBidder(rng, gamma_sigma=0.1, init_gamma=0.8, inference='search'),
+               ValueLearningBidder(rng, gamma_sigma=0.1, init_gamma=0.8, inference='policy'),
+               PolicyLearningBidder(rng, gamma_sigma=0.1, loss='REINFORCE', init_gamma=0.8),
+               DoublyRobustBidder(rng, gamma_sigma=0.1, init_gamma=0.8)]
+    for bidder in bidders:
+        bidder.model_initialised = initialised
+    return bidders
+
+
+class TestBidBatch(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.values = rng.lognormal(0.1, 0.2, 50)
+        self.estimated_CTRs = rng.uniform(0.01, 0.2, 50)
+        self.contexts = rng.normal(size=(50, 5))
+
+    def bid_scalar(self, bidder):
+        return np.array([bidder.bid(value, context, CTR) for value, context, CTR in zip(self.values, self.contexts, self.estimated_CTRs)])
+
+    def test_matches_scalar_path_when_exploring(self):
+        # Gaussian exploration and the value learning grid search consume the rng exactly like the scalar path
+        exploring_bidders = lambda: make_bidders(0, False) + make_bidders(0, True)[:3]
+        for scalar_bidder, batch_bidder in zip(exploring_bidders(), exploring_bidders()):
+            expected_bids = self.bid_scalar(scalar_bidder)
+            bids, gammas, propensities = batch_bidder.bid_batch(self.values, self.contexts, self.estimated_CTRs)
+            np.testing.assert_allclose(bids, expected_bids, rtol=1e-5)
+            np.testing.assert_allclose(batch_bidder.gammas, scalar_bidder.gammas, rtol=1e-5)
+            np.testing.assert_allclose(batch_bidder.propensities, scalar_bidder.propensities, rtol=1e-5)
+            if len(batch_bidder.shading_log):
+                np.testing.assert_array_equal(gammas, batch_bidder.gammas)
+                np.testing.assert_array_equal(propensities, batch_bidder.propensities)
+
+    def test_learnt_policies_log_what_they_bid(self):
+        for bidder in make_bidders(1, True)[3:]:
+            bids, gammas, propensities = bidder.bid_batch(self.values, self.contexts, self.estimated_CTRs)
+            self.assertEqual(len(bidder.shading_log), len(bids))
+            np.testing.assert_array_equal(bidder.gammas, gammas)
+            np.testing.assert_array_equal(bidder.propensities, propensities)
+            np.testing.assert_allclose(bids, self.values * self.estimated_CTRs * gammas)
+            self.assertTrue(np.all((gammas >= 0.0) & (gammas <= 1.0)))
+            self.assertTrue(np.all(propensities > 0.0))
+
+    def test_learnt_policies_log_plain_floats(self):
+        for bidder in make_bidders(2, True)[4:]:
+            bids = self.bid_scalar(bidder)
+            self.assertEqual(bids.dtype, np.float64)
+            self.assertEqual(len(bidder.shading_log), len(bids))
+            for column in (bidder.gammas, bidder.propensities):
+                self.assertEqual(column.dtype, np.float64)
+                self.assertTrue(all(isinstance(entry, (float, np.floating)) for entry in column))
+            # Nothing in the log holds on to an autograd graph
+            logged = list(vars(bidder.shading_log).values()) + list(bidder.shading_log.columns.values())
+            self.assertFalse(any(isinstance(entry, torch.Tensor) and entry.requires_grad for entry in logged))
+            np.testing.assert_allclose(bids, self.values * self.estimated_CTRs * bidder.gammas)
+
+
+class TestRootSearch(unittest.TestCase):
+    def test_matches_a_dense_grid_search(self):
+        rng = np.random.default_rng(0)
+        estimated_CTRs, values = rng.uniform(0.01, 0.2, 200), rng.lognormal(0.1, 0.2, 200)
+        gamma_grid = np.linspace(0.1, 1.0, 100001)
+        for slope in [-1.0, 0.5, 4.0, 12.0]:
+            bidder = ValueLearningBidder(rng, gamma_sigma=0.1, search_method='root')
+            with torch.no_grad():
+                bidder.winrate_model.model[0].weight.copy_(torch.Tensor([[3.0, 0.5, slope]]))
+                bidder.winrate_model.model[0].bias.fill_(-4.0)
+            bidder.model_initialised = True
+
+            bids, gammas, _ = bidder.bid_batch(values, None, estimated_CTRs)
+            self.assertTrue(np.all((gammas >= 0.1) & (gammas <= 1.0)))
+            for CTR, value, gamma in zip(estimated_CTRs[:10], values[:10], gammas[:10]):
+                x = torch.Tensor(np.column_stack((np.full_like(gamma_grid, CTR), np.full_like(gamma_grid, value), gamma_grid)))
+                with torch.no_grad():
+                    utilities = bidder.winrate_model(x).numpy().ravel() * (1.0 - gamma_grid)
+                self.assertAlmostEqual(gamma, gamma_grid[np.argmax(utilities)], delta=1e-4)
+                self.assertAlmostEqual(bidder.bid(value, None, CTR), value * CTR * gamma, places=6)
+
+
+def bucket_utilities_loop(gammas, utilities, grid_delta):
+    ''' The per-bucket loop `EmpiricalShadedBidder.bucket_utilities` replaces '''
+    min_gamma, max_gamma = np.min(gammas), np.max(gammas)
+    buckets = np.linspace(min_gamma, max_gamma, int((max_gamma-min_gamma) // grid_delta) + 1)
+    x, mean, stderr = [], [], []
+    for bucket_lo, bucket_hi in zip(buckets[:-1], buckets[1:]):
+        x.append((bucket_hi-bucket_lo)/2.0 + bucket_lo)
+        mask = np.logical_and(gammas < bucket_hi, bucket_lo <= gammas)
+        num_samples = len(utilities[mask])
+        mean.append(utilities[mask].mean() if num_samples > 1 else np.nan)
+        stderr.append(np.std(utilities[mask]) / np.sqrt(num_samples) if num_samples > 1 else np.nan)
+    return np.asarray(x), np.asarray(mean), np.asarray(stderr)
+
+
+class TestEmpiricalShading(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.gammas = np.clip(rng.normal(0.7, 0.1, 20000), 0.0, 1.0)
+        self.utilities = ((rng.random(20000) < self.gammas) * (1.0 - self.gammas) + rng.normal(0.0, 0.1, 20000)).astype(np.float32)
+
+    def test_buckets_match_the_loop(self):
+        for grid_delta in [.005, .05]:
+            bidder = EmpiricalShadedBidder(np.random.default_rng(0), gamma_sigma=0.1, grid_delta=grid_delta)
+            for actual, expected in zip(bidder.bucket_utilities(self.gammas, self.utilities),
+                                        bucket_utilities_loop(self.gammas, self.utilities, grid_delta)):
+                np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-7)
+
+    def test_wide_kernel_pools_every_sample(self):
+        bidder = EmpiricalShadedBidder(np.random.default_rng(0), gamma_sigma=0.1, smoothing_bandwidth=100.0)
+        _, mean, stderr = bidder.bucket_utilities(self.gammas, self.utilities)
+        # Every sample but the one at the top of the range lands in a bucket
+        pooled = self.utilities[self.gammas < self.gammas.max()]
+        np.testing.assert_allclose(mean, pooled.mean(), rtol=1e-4)
+        np.testing.assert_allclose(stderr, pooled.std() / np.sqrt(len(pooled)), rtol=1e-3)
+
+
+class TestBidLandscape(unittest.TestCase):
+    def test_bids_maximise_utility_under_the_landscape(self):
+        rng = np.random.default_rng(0)
+        values, estimated_CTRs = rng.lognormal(0.1, 0.2, 2000), rng.uniform(0.01, 0.2, 2000)
+        competing_bids = rng.lognormal(-3.5, 0.5, 2000)
+        for bidder in [ValueLearningBidder(rng, gamma_sigma=0.1, search_method='root', winrate_model='landscape'),
+                       ValueLearningBidder(rng, gamma_sigma=0.1, search_method='grid', winrate_model='landscape')]:
+            bids, _, _ = bidder.bid_batch(values, None, estimated_CTRs)
+            won = bids > competing_bids
+            bidder.observe_competing_bids(competing_bids)
+            bidder.update(None, values, bids, bids * won, won, estimated_CTRs, won, 0, False, None, None, 'test')
+            self.assertTrue(bidder.model_initialised)
+
+            bids, gammas, _ = bidder.bid_batch(values[:20], None, estimated_CTRs[:20])
+            gamma_grid = np.linspace(0.1, 1.0, 10001)
+            for expected_value, gamma in zip(values[:20] * estimated_CTRs[:20], gammas):
+                utilities = np.mean(competing_bids < gamma_grid.reshape(-1, 1) * expected_value, axis=1) * (1.0 - gamma_grid)
+                utility = np.mean(competing_bids < gamma * expected_value) * (1.0 - gamma)
+                self.assertGreater(utility, utilities.max() - 0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from main import load_checkpoint, save_checkpoint
+from test_auction import make_auction
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_restored_auction_continues_identically(self):
+        config = {'random_seed': 0, 'num_iter': 2}
+        auction = make_auction(seed=3)
+        auction.simulate_batch(200)
+        for agent in auction.agents:
+            agent.clear_logs()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'checkpoints', 'run_0.pkl')
+            save_checkpoint(path, {'config': config, 'auction': auction})
+            # Extending a run is allowed, changing its settings is not
+            restored = load_checkpoint(path, dict(config, num_iter=5))['auction']
+            with self.assertRaises(ValueError):
+                load_checkpoint(path, dict(config, random_seed=1))
+
+        # Agents still share the auction's generator after unpickling
+        self.assertIs(restored.agents[0].rng, restored.rng)
+        auction.simulate_batch(300)
+        restored.simulate_batch(300)
+        self.assertEqual(auction.revenue, restored.revenue)
+        for agent, restored_agent in zip(auction.agents, restored.agents):
+            np.testing.assert_array_equal(agent.logs.bids, restored_agent.logs.bids)
+            np.testing.assert_array_equal(agent.logs.won, restored_agent.logs.won)
+
+
+if __name__ == '__main__':
+    unittest.main()
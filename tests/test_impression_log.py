@@ -0,0 +1,82 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from Impression import ImpressionLog, ShadingLog
+
+
+class TestImpressionLog(unittest.TestCase):
+    def fill(self, log, num_rows, offset=0):
+        contexts = np.arange(num_rows * 3, dtype=np.float64).reshape(num_rows, 3) + offset
+        rows = log.extend(contexts, np.zeros(num_rows, dtype=int), np.arange(num_rows) + offset, np.ones(num_rows), np.full(num_rows, .5))
+        return rows
+
+    def test_grows_and_returns_views(self):
+        log = ImpressionLog(capacity=4)
+        for offset in range(0, 30, 10):
+            self.fill(log, 10, offset)
+        self.assertEqual(len(log), 30)
+        self.assertEqual(log.contexts.shape, (30, 3))
+        np.testing.assert_array_equal(log.values, np.arange(30))
+        # Column properties are views, not copies
+        self.assertTrue(np.shares_memory(log.values, log.columns['value']))
+
+    def test_set_by_index_and_slice(self):
+        log = ImpressionLog()
+        log.append(np.ones(3), 0, 1.0, 0.5, 0.1)
+        log.set_price_outcome(-1, 0.25, 0.2, True, won=True)
+        rows = self.fill(log, 5)
+        log.set_price_outcome(rows, np.full(5, .3), np.full(5, .1), np.ones(5, dtype=bool), won=np.arange(5) % 2 == 0)
+        self.assertTrue(log[0].won)
+        self.assertAlmostEqual(log[0].price, 0.25)
+        np.testing.assert_array_equal(log.won, [True, True, False, True, False, True])
+
+    def test_clear_keeps_the_most_recent_rows(self):
+        log = ImpressionLog()
+        self.fill(log, 10)
+        log.clear(keep=3)
+        np.testing.assert_array_equal(log.values, [7, 8, 9])
+        log.clear()
+        self.assertEqual(len(log), 0)
+
+    def test_memory_window_wraps_without_growing(self):
+        log = ImpressionLog(capacity=16)
+        expected = []
+        for iteration in range(10):
+            self.fill(log, 10, offset=100 * iteration)
+            expected.extend(range(100 * iteration, 100 * iteration + 10))
+            np.testing.assert_array_equal(log.values, expected)
+            np.testing.assert_array_equal(log.contexts[-10:, 0], 3 * np.arange(10) + 100 * iteration)
+            log.clear(keep=6)
+            expected = expected[-6:]
+        # Retained window plus one iteration fits, so the buffer stopped growing
+        self.assertEqual(log.capacity, 16)
+        np.testing.assert_array_equal(log.values, expected)
+        self.assertEqual(log[0].value, expected[0])
+
+    def test_writes_across_the_wrap_point(self):
+        log = ImpressionLog(capacity=8)
+        self.fill(log, 6)
+        log.clear(keep=1)
+        rows = self.fill(log, 6)
+        log.set_price_outcome(rows, np.arange(6) / 10, 0.0, True, won=True)
+        np.testing.assert_allclose(log.prices, np.concatenate(([0.0], np.arange(6) / 10)))
+        np.testing.assert_array_equal(log.contexts[1:, 0], 3 * np.arange(6))
+        np.testing.assert_allclose(log.read('price', rows), np.arange(6) / 10)
+
+    def test_shading_log_stays_aligned(self):
+        shading_log = ShadingLog(capacity=4)
+        for gamma in np.linspace(0.1, 1.0, 10):
+            shading_log.append(gamma, propensity=2.0)
+        shading_log.clear(keep=3)
+        shading_log.extend(np.array([0.5, 0.6]))
+        np.testing.assert_allclose(shading_log.gammas, [0.8, 0.9, 1.0, 0.5, 0.6])
+        np.testing.assert_allclose(shading_log.propensities, [2.0, 2.0, 2.0, 1.0, 1.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
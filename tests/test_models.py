@@ -0,0 +1,158 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from BidderAllocation import OnlineLogisticRegressionAllocator, PyTorchLogisticRegressionAllocator
+from Models import BidLandscape, PyTorchLogisticRegression, PyTorchWinRateEstimator
+
+
+def make_click_data(seed=0, num_samples=2000, embedding_size=5, num_items=2):
+    rng = np.random.default_rng(seed)
+    X = np.hstack((rng.normal(size=(num_samples, embedding_size)), np.ones((num_samples, 1))))
+    A = rng.integers(0, num_items, num_samples)
+    true_m = np.hstack((rng.normal(size=(num_items, embedding_size)), -3.0 * np.ones((num_items, 1))))
+    y = (rng.random(num_samples) < 1.0 / (1.0 + np.exp(-(X * true_m[A]).sum(axis=1)))).astype(np.float64)
+    return X, A, y
+
+
+class TestNewtonSolver(unittest.TestCase):
+    def test_reaches_the_map_estimate(self):
+        torch.manual_seed(0)
+        X, A, y = make_click_data()
+        allocator = PyTorchLogisticRegressionAllocator(np.random.default_rng(0), 5, 2, solver='newton')
+        model = allocator.response_model
+        X, A, y = torch.Tensor(X), torch.LongTensor(A), torch.Tensor(y)
+        model.fit_newton(X, A, y)
+
+        # The gradient of the loss Adam minimises vanishes at the solution
+        loss = model.loss(model.predict_item(X, A), y)
+        loss.backward()
+        self.assertLess(model.m.grad.abs().max().item(), 1e-2)
+
+    def test_update_without_clicks_stays_finite(self):
+        torch.manual_seed(0)
+        X, A, _ = make_click_data(num_samples=200)
+        allocator = PyTorchLogisticRegressionAllocator(np.random.default_rng(0), 5, 2, solver='newton')
+        allocator.update(X, A, np.zeros(len(A)), 0, False, None, None, 'Agent')
+        self.assertTrue(torch.isfinite(allocator.response_model.m).all())
+        self.assertTrue(torch.isfinite(allocator.response_model.q).all())
+
+
+
+class TestWinRateNewton(unittest.TestCase):
+    def test_reaches_the_penalised_optimum(self):
+        torch.manual_seed(0)
+        rng = np.random.default_rng(0)
+        X = np.column_stack((rng.uniform(0.01, 0.1, 4000), rng.lognormal(0.1, 0.2, 4000), rng.uniform(0.0, 1.0, 4000)))
+        won = rng.random(4000) < 1.0 / (1.0 + np.exp(-(20.0 * X[:, 0] + X[:, 1] + 4.0 * X[:, 2] - 4.0)))
+        X, y = torch.Tensor(X), torch.Tensor(won.reshape(-1, 1))
+        model = PyTorchWinRateEstimator()
+        model.fit_newton(X, y, weight_decay=1e-6)
+
+        # The gradient of the objective Adam minimises vanishes at the solution
+        loss = torch.nn.BCELoss()(model(X), y) + 0.5 * 1e-6 * sum((p**2).sum() for p in model.parameters())
+        loss.backward()
+        self.assertLess(max(p.grad.abs().max().item() for p in model.parameters()), 1e-4)
+
+
+class TestBidLandscape(unittest.TestCase):
+    def test_interpolates_the_empirical_cdf(self):
+        rng = np.random.default_rng(0)
+        competing_bids = rng.lognormal(-2.0, 0.5, 20000)
+        landscape = BidLandscape()
+        landscape.fit(competing_bids)
+        bids = np.quantile(competing_bids, [0.0, 0.1, 0.5, 0.9, 1.0]) * [0.5, 1.01, 1.0, 0.99, 2.0]
+        np.testing.assert_allclose(landscape.win_probability(bids), [np.mean(competing_bids < bid) for bid in bids], atol=5e-3)
+
+        # The torch module answers the same, from (P(click), value, gamma), and is differentiable in gamma
+        x = torch.tensor(np.column_stack((np.full(5, 0.5), np.full(5, 2.0), bids)), dtype=torch.float32, requires_grad=True)
+        prob_win = landscape(x)
+        np.testing.assert_allclose(prob_win.detach().numpy().ravel(), landscape.win_probability(bids), atol=1e-6)
+        prob_win.sum().backward()
+        self.assertTrue(np.all(x.grad[1:4, 2].numpy() > 0.0))
+
+    def test_utility_maximising_gamma_matches_a_dense_grid(self):
+        rng = np.random.default_rng(1)
+        landscape = BidLandscape(num_knots=32)
+        landscape.fit(np.concatenate((rng.lognormal(-2.0, 0.5, 5000), np.zeros(500))))
+        expected_values = rng.uniform(0.02, 0.5, 20)
+        gammas = landscape.utility_maximising_gamma(expected_values, np.ones(20))
+        gamma_grid = np.linspace(0.1, 1.0, 100001)
+        for expected_value, gamma in zip(expected_values, gammas):
+            utilities = landscape.win_probability(gamma_grid * expected_value) * (1.0 - gamma_grid)
+            self.assertAlmostEqual(landscape.win_probability(gamma * expected_value) * (1.0 - gamma), utilities.max(), places=6)
+
+
+class TestLaplaceApproximation(unittest.TestCase):
+    def test_batch_matches_per_item(self):
+        torch.manual_seed(0)
+        X, A, _ = make_click_data(num_items=7)
+        X, A = torch.Tensor(X), torch.LongTensor(A)
+        per_item = PyTorchLogisticRegression(n_dim=5, n_items=7)
+        batch = PyTorchLogisticRegression(n_dim=5, n_items=7)
+        batch.load_state_dict(per_item.state_dict())
+        with torch.no_grad():
+            for item in range(7):
+                per_item.laplace_approx(X[A == item], item)
+            batch.laplace_approx_batch(X, A)
+        np.testing.assert_allclose(batch.q.numpy(), per_item.q.numpy(), rtol=1e-5)
+
+
+class TestOnlineAllocator(unittest.TestCase):
+    def test_tracks_the_batch_estimate(self):
+        X, A, y = make_click_data(num_samples=20000)
+        online = OnlineLogisticRegressionAllocator(np.random.default_rng(0), 5, 2)
+        # Micro-batches of any size give the same result as one observation at a time
+        online.observe(X[:7], A[:7], y[:7])
+        online.observe(X[7:], A[7:], y[7:])
+
+        batch = PyTorchLogisticRegressionAllocator(np.random.default_rng(0), 5, 2, solver='newton')
+        with torch.no_grad():
+            batch.response_model.m.zero_()
+        batch.response_model.update_prior()
+        batch.response_model.fit_newton(torch.Tensor(X), torch.LongTensor(A), torch.Tensor(y))
+        batch.refresh_posterior()
+
+        rows = np.arange(len(A))
+        online_CTRs = online.estimate_CTR_batch(X, sample=False)[rows, A]
+        batch_CTRs = batch.estimate_CTR_batch(X, sample=False)[rows, A]
+        log_loss = lambda p: -np.mean(y * np.log(p) + (1 - y) * np.log(1 - p))
+        self.assertLess(log_loss(online_CTRs), log_loss(batch_CTRs) + 0.01)
+        self.assertTrue(np.all(online.q > 1.0))
+
+        sampled_CTRs = online.estimate_CTR_batch(X[:5])
+        self.assertEqual(sampled_CTRs.shape, (5, 2))
+
+
+class TestFusedInference(unittest.TestCase):
+    def test_matches_the_torch_model(self):
+        torch.manual_seed(0)
+        X, A, y = make_click_data(num_samples=500, num_items=3)
+        allocator = PyTorchLogisticRegressionAllocator(np.random.default_rng(0), 5, 3, solver='newton')
+        allocator.update(X, A, y, 0, False, None, None, 'test')
+        model = allocator.response_model
+
+        # The cached posterior is refreshed by `update`
+        with torch.no_grad():
+            torch_CTRs = model(torch.Tensor(X)).numpy()
+        sampled_CTRs, MAP_CTRs = allocator.estimate_CTR_batch_and_MAP(X)
+        np.testing.assert_allclose(MAP_CTRs, torch_CTRs, rtol=1e-4)
+        self.assertFalse(np.allclose(sampled_CTRs, MAP_CTRs))
+        sampled_CTR, MAP_CTR = allocator.estimate_CTR_and_MAP(X[0])
+        np.testing.assert_allclose(MAP_CTR, torch_CTRs[0], rtol=1e-4)
+
+        # Pooled noise gives the posterior spread 1 / sqrt(q) on the logits
+        contexts = np.tile(X[0], (20000, 1))
+        sampled_CTRs = allocator.estimate_CTR_batch(contexts)
+        sampled_logits = np.log(sampled_CTRs) - np.log1p(-sampled_CTRs)
+        expected_std = np.sqrt((X[0] ** 2 / model.q.numpy()).sum(axis=1))
+        np.testing.assert_allclose(sampled_logits.std(axis=0), expected_std, rtol=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
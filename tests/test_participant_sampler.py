@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from ParticipantSampler import ParticipantSampler
+
+
+class TestParticipantSampler(unittest.TestCase):
+    def assert_distinct_rows(self, participants, num_agents):
+        self.assertTrue(np.all((participants >= 0) & (participants < num_agents)))
+        for row in participants:
+            self.assertEqual(len(set(row)), len(row))
+
+    def test_dense_and_sparse_paths_sample_distinct_participants(self):
+        rng = np.random.default_rng(0)
+        for num_agents, rates in [(6, None), (5000, None), (5000, rng.uniform(0.5, 2.0, 5000))]:
+            sampler = ParticipantSampler(num_agents, 15 if num_agents > 6 else 4, participation_rates=rates)
+            self.assertEqual(sampler.sparse, num_agents > 6)
+            self.assert_distinct_rows(sampler.sample(rng, 2000), num_agents)
+            self.assert_distinct_rows(sampler.sample(rng)[None, :], num_agents)
+
+    def test_single_participant_follows_participation_rates(self):
+        rng = np.random.default_rng(1)
+        rates = np.array([1.0, 2.0, 3.0, 4.0])
+        sampler = ParticipantSampler(4, 1, participation_rates=rates)
+        counts = np.bincount(sampler.sample(rng, 40000).ravel(), minlength=4)
+        np.testing.assert_allclose(counts / counts.sum(), rates / rates.sum(), atol=.01)
+
+    def test_sparse_and_dense_weighted_inclusion_agree(self):
+        # A few agents with a large share of the rate make duplicate candidates common on the sparse path
+        rng = np.random.default_rng(2)
+        rates = np.where(np.arange(70) < 10, 8.0, 1.0)
+        sparse = ParticipantSampler(70, 8, participation_rates=rates, max_dense_agents=60)
+        dense = ParticipantSampler(70, 8, participation_rates=rates, max_dense_agents=1000)
+        self.assertTrue(sparse.sparse)
+        self.assertFalse(dense.sparse)
+        # Number of high-rate agents per round -- the exact exponential race on the dense path is the reference
+        num_rounds = 400000
+        sparse_high = (sparse.sample(rng, num_rounds) < 10).sum(axis=1)
+        dense_high = (dense.sample(rng, num_rounds) < 10).sum(axis=1)
+        stderr = np.sqrt((sparse_high.var() + dense_high.var()) / num_rounds)
+        self.assertLess(abs(sparse_high.mean() - dense_high.mean()), 4 * stderr)
+
+if __name__ == '__main__':
+    unittest.main()
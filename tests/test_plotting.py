@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from Bidder import EmpiricalShadedBidder
+from Diagnostics import DiagnosticRecord
+from Plotting import DiagnosticPlotter
+
+
+def make_update(seed=0, num_samples=20000):
+    rng = np.random.default_rng(seed)
+    bidder = EmpiricalShadedBidder(rng, gamma_sigma=0.1, init_gamma=0.7)
+    values, estimated_CTRs = rng.lognormal(0.1, 0.2, num_samples), rng.uniform(0.01, 0.2, num_samples)
+    bids, _, _ = bidder.bid_batch(values, None, estimated_CTRs)
+    won = bids > rng.lognormal(-3.5, 0.5, num_samples)
+    outcomes = rng.random(num_samples) < estimated_CTRs
+    return bidder, (None, values, bids, bids * won, outcomes, estimated_CTRs, won)
+
+
+class TestDiagnostics(unittest.TestCase):
+    def test_training_code_does_not_import_pyplot(self):
+        src = os.path.join(os.path.dirname(__file__), '..', 'src')
+        code = 'import sys; import Agent, Bidder, BidderAllocation, Models, Trainer; print("matplotlib.pyplot" in sys.modules)'
+        result = subprocess.run([sys.executable, '-c', code], cwd=src, capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), 'False')
+
+    def test_updates_record_only_when_plotting(self):
+        bidder, logs = make_update()
+        bidder.update(*logs, 0, False, None, None, 'Agent')
+        self.assertEqual(bidder.diagnostics, [])
+        bidder.update(*logs, 1, True, None, None, 'Agent')
+        self.assertEqual([record.kind for record in bidder.diagnostics], ['scatter', 'estimate'])
+        self.assertEqual(bidder.diagnostics[1].data['best'], bidder.prev_gamma)
+
+    def test_renders_with_reused_figures_and_downsampled_scatters(self):
+        bidder, logs = make_update()
+        bidder.update(*logs, 0, True, None, None, 'Agent')
+        records = bidder.diagnostics + [DiagnosticRecord('loss', 'Agent', 0, {'losses': np.linspace(1.0, 0.1, 100), 'label': 'Loss'})]
+        plotter = DiagnosticPlotter(max_points=1000)
+        with tempfile.TemporaryDirectory() as output_dir:
+            paths = plotter.render_all(records, os.path.join(output_dir, 'Agent_iter_0'))
+            self.assertTrue(all(os.path.getsize(path) > 0 for path in paths))
+            figures = dict(plotter.figures)
+            plotter.render_all(records, os.path.join(output_dir, 'Agent_iter_1'))
+        self.assertEqual(set(figures), {'scatter', 'estimate', 'loss'})
+        self.assertTrue(all(plotter.figures[kind] is figure for kind, figure in figures.items()))
+        scatter = plotter.figures['scatter'].axes[0].collections[0]
+        self.assertLessEqual(len(scatter.get_offsets()), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from RandomStreams import RandomStreams
+
+
+class TestRandomStreams(unittest.TestCase):
+    def test_draws_do_not_depend_on_block_size(self):
+        small = RandomStreams(42, block_size=7).stream('auction/contexts')
+        large = RandomStreams(42, block_size=4096).stream('auction/contexts')
+        a = np.concatenate([small.normal(size=5), small.normal(size=(3, 4)).ravel(), [small.normal()]])
+        b = large.normal(size=18)
+        np.testing.assert_allclose(a, b)
+
+    def test_draws_do_not_depend_on_interleaving(self):
+        first = RandomStreams(42, block_size=16).stream('bidder/A')
+        second = RandomStreams(42, block_size=16).stream('bidder/A')
+        uniforms_a, normals_a = [], []
+        for _ in range(40):
+            uniforms_a.append(first.random())
+            normals_a.append(first.normal(0.9, 0.05))
+        np.testing.assert_allclose(uniforms_a, second.random(40))
+        np.testing.assert_allclose(normals_a, 0.9 + 0.05 * second.standard_normal(40))
+
+    def test_purposes_and_runs_are_independent(self):
+        streams = RandomStreams(42)
+        self.assertFalse(np.allclose(streams.stream('auction/clicks').random(10), streams.stream('auction/conversions').random(10)))
+        self.assertFalse(np.allclose(RandomStreams(42, run=0).stream('x').random(10), RandomStreams(42, run=1).stream('x').random(10)))
+
+    def test_generator_interface(self):
+        stream = RandomStreams(0, block_size=32).stream('test')
+        slots = stream.integers(1, 4, size=1000)
+        self.assertTrue(np.all((slots >= 1) & (slots < 4)))
+        self.assertEqual(set(np.unique(slots)), {1, 2, 3})
+        clicks = stream.binomial(1, np.array([0.0, 1.0, 0.0]))
+        np.testing.assert_array_equal(clicks, [0, 1, 0])
+        sample = stream.choice(10, 4, replace=False)
+        self.assertEqual(len(set(sample)), 4)
+        self.assertTrue(np.isscalar(stream.normal(1.0, 0.1)))
+
+
+class TestSeedRun(unittest.TestCase):
+    def test_runs_are_reproducible_and_independent(self):
+        import torch
+        from main import seed_run
+
+        draws = {}
+        for run in [1, 0, 1]:
+            rng = seed_run(42, run)
+            draws.setdefault(run, []).append((rng.random(4), np.random.random(4), torch.rand(4).numpy()))
+        for a, b in zip(*draws[1]):
+            np.testing.assert_array_equal(a, b)
+        for a, b in zip(draws[0][0], draws[1][0]):
+            self.assertFalse(np.allclose(a, b))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from sweep import Journal, expand_jobs
+
+
+BASE_CONFIG = {
+    'num_runs': 1,
+    'num_iter': 2,
+    'rounds_per_iter': 100,
+    'num_participants_per_round': 2,
+    'agents': [
+        {'name': 'Learner', 'bidder': {'kwargs': {'reward_function_type': "'net_utility'"}}},
+        {'name': 'Competitor', 'num_copies': 2},
+    ],
+}
+
+
+class TestSweep(unittest.TestCase):
+    def test_expands_axes_longest_first(self):
+        sweep = {
+            'base_config': BASE_CONFIG,
+            'name': 'R{reward}_C{agents.1.num_copies}',
+            'output_root': 'out',
+            'axes': {
+                'reward': {'NU': {'agents.0.bidder.kwargs.reward_function_type': "'net_utility'"},
+                           'GU': {'agents.0.bidder.kwargs.reward_function_type': "'gross_utility'"}},
+                'agents.1.num_copies': [2, 8],
+            },
+        }
+        jobs = expand_jobs(sweep)
+        self.assertEqual(len(jobs), 4)
+        self.assertEqual({name for name, _ in jobs}, {'RNU_C2', 'RNU_C8', 'RGU_C2', 'RGU_C8'})
+        # More agents means more updates, so those jobs go first
+        self.assertEqual([config['agents'][1]['num_copies'] for _, config in jobs], [8, 8, 2, 2])
+        name, config = [job for job in jobs if job[0] == 'RGU_C2'][0]
+        self.assertEqual(config['agents'][0]['bidder']['kwargs']['reward_function_type'], "'gross_utility'")
+        self.assertEqual(config['output_dir'], os.path.join('out', 'RGU_C2') + '/')
+        # The base config is left untouched
+        self.assertEqual(BASE_CONFIG['agents'][1]['num_copies'], 2)
+
+    def test_journal_resumes_successful_jobs_only(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'journal.jsonl')
+            journal = Journal(path)
+            journal.record('done', BASE_CONFIG, 0, 1.0)
+            journal.record('failed', BASE_CONFIG, 1, 1.0)
+            with open(path, 'a') as f:
+                f.write('{"job": "cut sh')
+
+            resumed = Journal(path)
+            self.assertTrue(resumed.is_done('done', BASE_CONFIG))
+            self.assertFalse(resumed.is_done('failed', BASE_CONFIG))
+            # A changed config is a new job
+            self.assertFalse(resumed.is_done('done', dict(BASE_CONFIG, num_iter=3)))
+
+            # Entries recorded after the cut-off line are read back
+            resumed.record('failed', BASE_CONFIG, 0, 1.0)
+            self.assertTrue(Journal(path).is_done('failed', BASE_CONFIG))
+
+
+if __name__ == '__main__':
+    unittest.main()
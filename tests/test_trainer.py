@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from Trainer import Trainer
+
+
+def make_problem():
+    ''' A least-squares fit whose loss plateaus at the noise level '''
+    torch.manual_seed(0)
+    X = torch.randn(256, 3)
+    y = X @ torch.Tensor([1.0, -2.0, 0.5]) + 0.1 * torch.randn(256)
+    w = torch.zeros(3, requires_grad=True)
+    optimizer = torch.optim.Adam([w], lr=5e-2)
+    return (lambda rows: ((X[rows] @ w - y[rows])**2).mean()), optimizer, w
+
+
+class TestTrainer(unittest.TestCase):
+    def test_stops_once_the_loss_plateaus(self):
+        loss_fn, optimizer, w = make_problem()
+        stats = Trainer(check_every=32, progress=False).fit(loss_fn, optimizer, epochs=20000, patience=100, num_samples=256)
+        self.assertEqual(stats.stop_reason, 'converged')
+        self.assertEqual(len(stats.losses), stats.epochs)
+        # Detected within one check of the plateau
+        self.assertLessEqual(stats.epochs, stats.best_epoch + 100 + 32 + 1)
+        self.assertLessEqual(stats.best_loss - stats.losses.min(), 1e-6)
+        np.testing.assert_allclose(w.detach().numpy(), [1.0, -2.0, 0.5], atol=0.05)
+
+    def test_min_epochs_delays_the_stop(self):
+        loss_fn, optimizer, _ = make_problem()
+        stats = Trainer(progress=False).fit(loss_fn, optimizer, epochs=20000, patience=10, num_samples=256, min_delta=1e3, min_epochs=500)
+        self.assertEqual(stats.stop_reason, 'converged')
+        self.assertGreaterEqual(stats.epochs, 500)
+
+    def test_caps(self):
+        loss_fn, optimizer, _ = make_problem()
+        stats = Trainer(max_epochs=100, progress=False).fit(loss_fn, optimizer, epochs=20000, patience=20000, num_samples=256)
+        self.assertEqual((stats.epochs, stats.stop_reason), (100, 'max_epochs'))
+
+        stats = Trainer(check_every=1, max_seconds=0.0, progress=False).fit(loss_fn, optimizer, epochs=20000, patience=20000, num_samples=256)
+        self.assertEqual((stats.epochs, stats.stop_reason), (1, 'max_seconds'))
+
+    def test_scheduler_sees_every_epoch(self):
+        loss_fn, optimizer, _ = make_problem()
+        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min')
+        stats = Trainer(check_every=7, progress=False).fit(loss_fn, optimizer, epochs=50, patience=100, num_samples=256, scheduler=scheduler)
+        self.assertEqual(scheduler.last_epoch, stats.epochs)
+
+    def test_minibatches(self):
+        loss_fn, optimizer, w = make_problem()
+        batch_sizes = []
+        stats = Trainer(batch_size=100, progress=False).fit(lambda rows: batch_sizes.append(len(rows)) or loss_fn(rows), optimizer,
+                                                            epochs=200, patience=20, num_samples=256)
+        # Every epoch is one pass over all samples
+        self.assertEqual(batch_sizes[:3], [100, 100, 56])
+        self.assertEqual(len(batch_sizes), 3 * stats.epochs)
+        np.testing.assert_allclose(w.detach().numpy(), [1.0, -2.0, 0.5], atol=0.05)
+
+    def test_warm_start_keeps_the_optimizer(self):
+        _, _, w = make_problem()
+        make_optimizer = lambda: torch.optim.Adam([w], lr=1e-2)
+        trainer = Trainer(warm_start=True, progress=False)
+        optimizer = trainer.optimizer('w', make_optimizer)
+        optimizer.param_groups[0]['lr'] = 1e-5
+        self.assertIs(trainer.optimizer('w', make_optimizer), optimizer)
+        self.assertEqual(optimizer.param_groups[0]['lr'], 1e-2)
+        self.assertIsNot(Trainer().optimizer('w', make_optimizer), Trainer().optimizer('w', make_optimizer))
+
+
+if __name__ == '__main__':
+    unittest.main()